@@ -0,0 +1,60 @@
+# Benchmark -- risk-scoring throughput on a generated fact table
+
+import os
+import sys
+import time
+import argparse
+import duckdb
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src'))
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from Scoring import RiskScorer, WeightedRiskModel
+
+GENERATE_SILVER = """
+CREATE OR REPLACE TABLE silver_heart_disease AS
+SELECT
+    CAST(i AS INTEGER) AS patient_id,
+    CAST(28 + (hash(i, 1) % 50) AS INTEGER) AS age,
+    CASE WHEN hash(i, 2) % 4 = 0 THEN 'Female' ELSE 'Male' END AS sex,
+    CASE hash(i, 3) % 4 WHEN 0 THEN 'Typical Angina' WHEN 1 THEN 'Atypical Angina'
+                        WHEN 2 THEN 'Non-Anginal Pain' ELSE 'Asymptomatic' END AS chest_pain_type,
+    CASE WHEN hash(i, 4) % 20 = 0 THEN NULL ELSE CAST(90 + (hash(i, 4) % 110) AS INTEGER) END AS resting_blood_pressure,
+    CAST(120 + (hash(i, 5) % 400) AS INTEGER) AS cholesterol,
+    hash(i, 6) % 7 = 0 AS fasting_blood_sugar_high,
+    CAST(70 + (hash(i, 7) % 130) AS INTEGER) AS max_heart_rate,
+    hash(i, 8) % 3 = 0 AS exercise_induced_angina,
+    (hash(i, 9) % 60) / 10.0 AS st_depression,
+    CAST(hash(i, 10) % 4 AS INTEGER) AS num_major_vessels
+FROM range({rows}) t(i)
+"""
+
+
+def time_scoring(conn, scorer, label, rows):
+    expression = scorer.expression()
+    started = time.perf_counter()
+    conn.execute("CREATE OR REPLACE TABLE scored AS SELECT patient_id, {} AS calculated_risk_score FROM silver_heart_disease".format(expression))
+    elapsed = time.perf_counter() - started
+    print("{:<28} {:>10.2f}s {:>14,.0f} rows/s".format(label, elapsed, rows / elapsed))
+    return conn.execute("SELECT SUM(calculated_risk_score) FROM scored").fetchone()[0]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Risk-scoring throughput benchmark")
+    parser.add_argument('--rows', type=int, default=10000000)
+    parser.add_argument('--threads', type=int, default=None)
+    args = parser.parse_args()
+
+    conn = duckdb.connect(':memory:')
+    if args.threads:
+        conn.execute("SET threads = {}".format(int(args.threads)))
+    print("Generating {:,} rows...".format(args.rows))
+    conn.execute(GENERATE_SILVER.format(rows=int(args.rows)))
+
+    print("{:<28} {:>11} {:>20}".format("scorer", "time", "throughput"))
+    sql_total = time_scoring(conn, RiskScorer(conn, WeightedRiskModel()), "weighted rules (SQL)", args.rows)
+    udf_total = time_scoring(conn, RiskScorer(conn, WeightedRiskModel(), force_udf=True), "weighted rules (Arrow UDF)", args.rows)
+    if sql_total != udf_total:
+        print("Warning: SQL and Arrow UDF scores differ ({} vs {})".format(sql_total, udf_total))
+    conn.close()
+
+if __name__ == "__main__":
+    main()
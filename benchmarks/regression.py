@@ -0,0 +1,305 @@
+# Benchmark -- pipeline regression gate against the baselines stored in benchmarks/baselines.json
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import subprocess
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+BASELINES_PATH = os.path.join(BENCHMARK_DIR, 'baselines.json')
+ROOT_DIR = os.path.dirname(BENCHMARK_DIR)
+
+# Each scenario is a list of steps run in fresh processes on one warehouse directory;
+# only the last step is measured, the ones before it prepare its input.
+SCENARIOS = {
+    'full_100k': {'rows': 100000, 'steps': ['generate', 'full']},
+    'full_1m': {'rows': 1000000, 'steps': ['generate', 'full']},
+    'rerun_duplicates_1m': {'rows': 1000000, 'steps': ['generate', 'full', 'touch', 'full']},
+    'gold_from_snapshot_1m': {'rows': 1000000, 'steps': ['generate', 'full', 'gold']}
+}
+
+# Raw columns as in heart_disease_uci.csv; cholesterol below MIN_CHOLESTEROL fails the Silver
+# quality rules for about 2% of rows
+GENERATE_SOURCE = """
+COPY (
+    SELECT
+        CAST(i AS INTEGER) AS id,
+        CAST(25 + (hash(i, 1) % 60) AS INTEGER) AS age,
+        CASE WHEN hash(i, 2) % 4 = 0 THEN 'Female' ELSE 'Male' END AS sex,
+        CASE hash(i, 3) % 4 WHEN 0 THEN 'Cleveland' WHEN 1 THEN 'Hungary'
+                            WHEN 2 THEN 'Switzerland' ELSE 'VA Long Beach' END AS dataset,
+        CASE hash(i, 4) % 4 WHEN 0 THEN 'typical angina' WHEN 1 THEN 'atypical angina'
+                            WHEN 2 THEN 'non-anginal' ELSE 'asymptomatic' END AS cp,
+        CASE WHEN hash(i, 5) % 20 = 0 THEN NULL ELSE CAST(85 + (hash(i, 5) % 120) AS INTEGER) END AS trestbps,
+        CAST(90 + (hash(i, 6) % 500) AS INTEGER) AS chol,
+        hash(i, 7) % 7 = 0 AS fbs,
+        CASE hash(i, 8) % 3 WHEN 0 THEN 'normal' WHEN 1 THEN 'lv hypertrophy' ELSE 'st-t abnormality' END AS restecg,
+        CAST(65 + (hash(i, 9) % 140) AS INTEGER) AS thalch,
+        hash(i, 10) % 3 = 0 AS exang,
+        (hash(i, 11) % 62) / 10.0 AS oldpeak,
+        CASE hash(i, 12) % 3 WHEN 0 THEN 'upsloping' WHEN 1 THEN 'flat' ELSE 'downsloping' END AS slope,
+        CAST(hash(i, 13) % 4 AS INTEGER) AS ca,
+        CASE hash(i, 14) % 3 WHEN 0 THEN 'normal' WHEN 1 THEN 'fixed defect' ELSE 'reversable defect' END AS thal,
+        CAST(hash(i, 15) % 5 AS INTEGER) AS num
+    FROM range({rows}) t(i)
+) TO '{path}' (HEADER, DELIMITER ',')
+"""
+
+SOURCE_BUCKET = 'benchmark-source'
+SOURCE_KEY = 'heart_disease_generated.csv'
+TARGET_BUCKET = 'benchmark-warehouse'
+TARGET_BASE_FILE = 'Health_data'
+
+
+def step_environment(workdir):
+    """Settings for a step process: local storage under workdir, production mode, no publishing"""
+    environment = dict(os.environ)
+    environment.update({
+        'STORAGE_BACKEND': 'local',
+        'LOCAL_STORAGE_ROOT': os.path.join(workdir, 'storage'),
+        'SOURCE_BUCKET': SOURCE_BUCKET,
+        'SOURCE_KEY': SOURCE_KEY,
+        'TARGET_BUCKET': TARGET_BUCKET,
+        'TARGET_BASE_FILE': TARGET_BASE_FILE,
+        'DUCKDB_DATABASE': ':memory:',
+        'PRODUCTION_MODE': 'true',
+        'LOG_LEVEL': 'WARNING',
+        'TMPDIR': os.path.join(workdir, 'tmp'),
+        # Empty rather than unset, so a .env file cannot switch them back on
+        'SERVICE_DATABASE': '',
+        'S3_ENDPOINT_URL': ''
+    })
+    return environment
+
+
+def directory_bytes(path):
+    total = 0
+    for directory, _, files in os.walk(path):
+        total += sum(os.path.getsize(os.path.join(directory, file_name)) for file_name in files)
+    return total
+
+
+def peak_rss_mb():
+    import resource
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    return peak / (1024.0 * 1024.0) if sys.platform == 'darwin' else peak / 1024.0
+
+
+def run_step(step, workdir, rows):
+    """Body of a step process, prints its measurements as one JSON line"""
+    sys.path.append(os.path.join(ROOT_DIR, 'src'))
+    sys.path.append(ROOT_DIR)
+    storage_root = os.path.join(workdir, 'storage')
+
+    if step == 'generate':
+        import duckdb
+        source_dir = os.path.join(storage_root, SOURCE_BUCKET)
+        os.makedirs(source_dir, exist_ok=True)
+        conn = duckdb.connect(':memory:')
+        conn.execute(GENERATE_SOURCE.format(rows=int(rows), path=os.path.join(source_dir, SOURCE_KEY).replace("'", "''")))
+        conn.close()
+        print(json.dumps({'step': step}))
+        return
+    if step == 'touch':
+        # A new ETag for the same content, so the next run reads it again instead of skipping it
+        path = os.path.join(storage_root, SOURCE_BUCKET, SOURCE_KEY)
+        modified = os.stat(path).st_mtime + 1
+        os.utime(path, (modified, modified))
+        print(json.dumps({'step': step}))
+        return
+
+    import config
+    from pipeline import Warehouse_Pipeline
+    config.configure_logging()
+    pipeline = Warehouse_Pipeline()
+    started = time.perf_counter()
+    if step == 'full':
+        succeeded = pipeline.run(save_to_S3=True, export_to_powerbi=True)
+        stage_seconds = dict(pipeline.stage_timings)
+    elif step == 'gold':
+        pipeline.run_gold_layer(save_to_S3=True, export_to_powerbi=True)
+        succeeded = True
+        stage_seconds = {'gold': time.perf_counter() - started}
+    else:
+        raise ValueError("Unknown benchmark step: " + step)
+    duration = time.perf_counter() - started
+
+    warehouse = os.path.join(storage_root, TARGET_BUCKET, TARGET_BASE_FILE)
+    print(json.dumps({
+        'step': step,
+        'succeeded': succeeded,
+        'total_seconds': duration,
+        'stage_seconds': stage_seconds,
+        'peak_rss_mb': peak_rss_mb(),
+        'output_bytes': {
+            'bronze': directory_bytes(os.path.join(warehouse, 'Bronze')),
+            'silver': directory_bytes(os.path.join(warehouse, 'Silver')),
+            'gold': directory_bytes(os.path.join(warehouse, 'Gold')),
+            'powerbi': directory_bytes(os.path.join(workdir, 'tmp', 'powerbi_fact_table'))
+        },
+        'row_counts': pipeline.row_counts
+    }))
+
+
+def run_scenario(name, scenario, keep=False):
+    workdir = tempfile.mkdtemp(prefix='etl_benchmark_' + name + '_')
+    os.makedirs(os.path.join(workdir, 'tmp'), exist_ok=True)
+    try:
+        result = None
+        for step in scenario['steps']:
+            completed = subprocess.run(
+                [sys.executable, os.path.abspath(__file__), '--step', step, '--workdir', workdir, '--rows', str(scenario['rows'])],
+                env=step_environment(workdir), stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+            if completed.returncode != 0:
+                raise RuntimeError("Step " + step + " of " + name + " failed:\n" + completed.stderr[-4000:])
+            result = json.loads(completed.stdout.strip().splitlines()[-1])
+            if result.get('succeeded') is False:
+                raise RuntimeError("Step " + step + " of " + name + " reported a failed pipeline run:\n" + completed.stdout[-4000:])
+        result['rows'] = scenario['rows']
+        return result
+    finally:
+        if keep:
+            print("  kept " + workdir)
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+
+def median_result(results):
+    """Median timings over repeats; memory and sizes are taken from the slowest run"""
+    results = sorted(results, key=lambda result: result['total_seconds'])
+    median = dict(results[len(results) // 2])
+    stages = set().union(*[result['stage_seconds'] for result in results])
+    median['stage_seconds'] = {}
+    for stage in stages:
+        values = sorted(result['stage_seconds'].get(stage, 0.0) for result in results)
+        median['stage_seconds'][stage] = values[len(values) // 2]
+    median['peak_rss_mb'] = max(result['peak_rss_mb'] for result in results)
+    median['output_bytes'] = results[-1]['output_bytes']
+    return median
+
+
+def machine_info():
+    try:
+        import duckdb
+        duckdb_version = duckdb.__version__
+    except ImportError:
+        duckdb_version = None
+    return {
+        'platform': platform.platform(),
+        'processor': platform.processor() or platform.machine(),
+        'cpu_count': os.cpu_count(),
+        'python': platform.python_version(),
+        'duckdb': duckdb_version
+    }
+
+
+def metric_rows(result):
+    """Flatten a result into (metric, value, kind) rows"""
+    rows = [('total_seconds', result['total_seconds'], 'time')]
+    rows += [('stage.' + stage, seconds, 'time') for stage, seconds in sorted(result['stage_seconds'].items())]
+    rows.append(('peak_rss_mb', result['peak_rss_mb'], 'memory'))
+    rows += [('output_bytes.' + layer, size, 'size') for layer, size in sorted(result['output_bytes'].items())]
+    return rows
+
+
+def compare(name, result, baseline, thresholds, floors):
+    """Print a per-metric diff against the baseline, return the metrics that regressed"""
+    previous = dict((metric, value) for metric, value, _ in metric_rows(baseline))
+    regressions = []
+    print("\n {} ({:,} rows)".format(name, result['rows']))
+    print("  {:<24} {:>14} {:>14} {:>9}".format("metric", "baseline", "current", "change"))
+    for metric, value, kind in metric_rows(result):
+        base = previous.get(metric)
+        if base is None:
+            print("  {:<24} {:>14} {:>14.3f} {:>9}".format(metric, "-", value, "new"))
+            continue
+        change = (value - base) / base if base else 0.0
+        regressed = value - base > floors[kind] and change > thresholds[kind]
+        print("  {:<24} {:>14.3f} {:>14.3f} {:>+8.1%}{}".format(metric, base, value, change, "  REGRESSION" if regressed else ""))
+        if regressed:
+            regressions.append(metric)
+    return regressions
+
+
+def load_baselines():
+    if not os.path.exists(BASELINES_PATH):
+        return {'machine': None, 'scenarios': {}}
+    with open(BASELINES_PATH) as f:
+        return json.load(f)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Pipeline benchmark scenarios, gated against stored baselines")
+    parser.add_argument('--scenarios', default=None, help="Comma-separated scenarios to run (default all: " + ", ".join(SCENARIOS) + ")")
+    parser.add_argument('--repeat', type=int, default=3, help="Runs per scenario, timings are the median")
+    parser.add_argument('--threshold', type=float, default=0.20, help="Allowed relative slowdown of any time metric")
+    parser.add_argument('--memory-threshold', type=float, default=0.20, help="Allowed relative growth of peak memory")
+    parser.add_argument('--size-threshold', type=float, default=0.10, help="Allowed relative growth of output sizes")
+    parser.add_argument('--update-baseline', action='store_true', help="Store the results as the new baselines instead of comparing")
+    parser.add_argument('--keep', action='store_true', help="Keep the scenario working directories")
+    parser.add_argument('--step', default=None, help=argparse.SUPPRESS)
+    parser.add_argument('--workdir', default=None, help=argparse.SUPPRESS)
+    parser.add_argument('--rows', type=int, default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.step:
+        run_step(args.step, args.workdir, args.rows)
+        return
+
+    names = [name.strip() for name in args.scenarios.split(',')] if args.scenarios else list(SCENARIOS)
+    unknown = [name for name in names if name not in SCENARIOS]
+    if unknown:
+        parser.error("Unknown scenarios: " + ", ".join(unknown))
+
+    baselines = load_baselines()
+    machine = machine_info()
+    if baselines.get('machine') and baselines['machine'] != machine and not args.update_baseline:
+        print("Warning: baselines were recorded on a different machine or DuckDB version: " + json.dumps(baselines['machine']))
+
+    thresholds = {'time': args.threshold, 'memory': args.memory_threshold, 'size': args.size_threshold}
+    # Changes below these absolute amounts are noise, whatever their relative size
+    floors = {'time': 0.05, 'memory': 16.0, 'size': 64 * 1024}
+    results = {}
+    failed = []
+    for name in names:
+        print("Running {} ({} x {})...".format(name, str(args.repeat), " > ".join(SCENARIOS[name]['steps'])))
+        try:
+            result = median_result([run_scenario(name, SCENARIOS[name], args.keep) for _ in range(max(1, args.repeat))])
+        except (RuntimeError, ValueError) as e:
+            # A broken scenario fails the gate, the remaining ones still run
+            print("  FAILED: " + str(e))
+            failed.append(name + " (failed to run)")
+            continue
+        results[name] = result
+        if args.update_baseline:
+            continue
+        baseline = baselines['scenarios'].get(name)
+        if baseline is None:
+            print("  no baseline for {}, run with --update-baseline to record one".format(name))
+            continue
+        regressions = compare(name, result, baseline, thresholds, floors)
+        if regressions:
+            failed.append(name + " (" + ", ".join(regressions) + ")")
+
+    if args.update_baseline and results:
+        baselines['machine'] = machine
+        baselines['scenarios'].update(results)
+        with open(BASELINES_PATH, 'w') as f:
+            json.dump(baselines, f, indent=2, sort_keys=True)
+            f.write("\n")
+        print("Baselines for {} written to {}".format(", ".join(results), BASELINES_PATH))
+
+    if failed:
+        print("\nBenchmark gate failed, regressed or broken scenarios: " + "; ".join(failed))
+        sys.exit(1)
+    if not args.update_baseline:
+        print("\nNo performance regressions.")
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,9 @@
 # Configuration file for the usage of AWS S3 services and constraints for the data
 
 import os
+import sys
+import json
+import logging
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -14,10 +17,80 @@ SOURCE_KEY = os.getenv("SOURCE_KEY", "heart_disease_uci.csv")
 TARGET_BUCKET = os.getenv("TARGET_BUCKET", "data-endpoint")
 TARGET_BASE_FILE = os.getenv("TARGET_BASE_FILE", "Health_data")
 
+#Storage Backend ('s3', or 'local' to map buckets to directories under LOCAL_STORAGE_ROOT)
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "s3")
+LOCAL_STORAGE_ROOT = os.getenv("LOCAL_STORAGE_ROOT")
+
+# S3-compatible endpoint instead of AWS, e.g. http://localhost:9000 for a local MinIO
+S3_ENDPOINT_URL = os.getenv("S3_ENDPOINT_URL")
+S3_MAX_POOL_CONNECTIONS = int(os.getenv("S3_MAX_POOL_CONNECTIONS", "64"))
+
+# In-flight HEAD and LIST calls of the metadata pre-flight checks
+METADATA_MAX_CONCURRENCY = int(os.getenv("METADATA_MAX_CONCURRENCY", "32"))
+
 BRONZE_PREFIX = TARGET_BASE_FILE + "/Bronze/"
 SILVER_PREFIX = TARGET_BASE_FILE + "/Silver/"
 GOLD_PREFIX = TARGET_BASE_FILE + "/Gold/"
 
+# Optional override for Gold-only runs, a local path or s3:// URI to a Silver Parquet file
+# (Gold-only runs read the current Silver snapshot by default)
+SILVER_PARQUET_PATH = os.getenv("SILVER_PARQUET_PATH")
+
+#Snapshot Tables
+SNAPSHOT_TARGET_FILE_BYTES = int(os.getenv("SNAPSHOT_TARGET_FILE_BYTES", str(128 * 1024 * 1024)))
+PARQUET_ROW_GROUP_SIZE = int(os.getenv("PARQUET_ROW_GROUP_SIZE", "122880"))
+SNAPSHOT_RETAIN = int(os.getenv("SNAPSHOT_RETAIN", "10"))
+
+#Bronze Deduplication (rows whose content hash was ingested by an earlier run are skipped)
+BRONZE_DEDUPLICATE = os.getenv("BRONZE_DEDUPLICATE", "true").lower() == "true"
+
+#Compaction (files under COMPACTION_SMALL_FILE_BYTES are merged into SNAPSHOT_TARGET_FILE_BYTES files)
+COMPACTION_SMALL_FILE_BYTES = int(os.getenv("COMPACTION_SMALL_FILE_BYTES", str(32 * 1024 * 1024)))
+COMPACTION_TABLES = {
+    'bronze': ['bronze_heart_disease', 'bronze_fingerprints'],
+    'silver': ['silver_heart_disease']
+}
+
+#Clustering (sort order at materialization and export, so min/max statistics can skip files and row groups)
+# Appended snapshots (micro-batches, deduplicated runs) are sorted per append only. Compaction sorts
+# the small files it merges, but files from different appends keep overlapping key ranges.
+SILVER_CLUSTER_KEYS = [key.strip() for key in os.getenv("SILVER_CLUSTER_KEYS", "dataset,patient_id").split(',') if key.strip()]
+GOLD_FACT_CLUSTER_KEYS = [key.strip() for key in os.getenv("GOLD_FACT_CLUSTER_KEYS", "dataset_key,patient_id").split(',') if key.strip()]
+
+CLUSTER_KEYS = {
+    'bronze_heart_disease': ['dataset', 'id'],
+    'bronze_fingerprints': ['fingerprint'],
+    'silver_heart_disease': SILVER_CLUSTER_KEYS,
+    'gold_powerbi_fact_table': GOLD_FACT_CLUSTER_KEYS
+}
+
+#Logging (PRODUCTION_MODE skips sample rows, diagnostic COUNT(*) queries, profiles and display tables)
+PRODUCTION_MODE = os.getenv("PRODUCTION_MODE", "false").lower() == "true"
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json" if PRODUCTION_MODE else "text")
+
+#DuckDB database file (':memory:' for a throwaway database per run)
+DUCKDB_DATABASE = os.getenv("DUCKDB_DATABASE", ":memory:")
+
+#Query Service (the pipeline publishes Silver and Gold to versioned files behind SERVICE_DATABASE + ".current" when it is set)
+SERVICE_DATABASE = os.getenv("SERVICE_DATABASE")
+SERVICE_HOST = os.getenv("SERVICE_HOST", "127.0.0.1")
+SERVICE_PORT = int(os.getenv("SERVICE_PORT", "8765"))
+SERVICE_POOL_SIZE = int(os.getenv("SERVICE_POOL_SIZE", "4"))
+SERVICE_CACHE_SIZE = int(os.getenv("SERVICE_CACHE_SIZE", "256"))
+
+#Micro-batch Streaming
+LANDING_PREFIX = os.getenv("LANDING_PREFIX", "landing/")
+STREAM_POLL_INTERVAL_SECONDS = float(os.getenv("STREAM_POLL_INTERVAL_SECONDS", "10"))
+STREAM_MAX_BATCH_BYTES = int(os.getenv("STREAM_MAX_BATCH_BYTES", str(64 * 1024 * 1024)))
+STREAM_MAX_WAIT_SECONDS = float(os.getenv("STREAM_MAX_WAIT_SECONDS", "60"))
+STREAM_LATENCY_TARGET_SECONDS = float(os.getenv("STREAM_LATENCY_TARGET_SECONDS", "300"))
+
+#Multi-dataset Runner (shared DuckDB instance for all datasets of a run)
+RUNNER_MAX_CONCURRENT_DATASETS = int(os.getenv("RUNNER_MAX_CONCURRENT_DATASETS", "4"))
+RUNNER_THREADS = int(os.getenv("RUNNER_THREADS", str(os.cpu_count() or 4)))
+RUNNER_MEMORY_LIMIT = os.getenv("RUNNER_MEMORY_LIMIT", "8GB")
+
 #Data Quality Constraints
 
 MIN_AGE = 18
@@ -31,6 +104,31 @@ MAX_HEART_RATE = 220
 MIN_ST_DEPRESSION = 0.0
 MAX_ST_DEPRESSION = 10.0
 
+#Risk Scoring
+
+# (column, operator, threshold, weight): weight is added when `column operator threshold` holds
+RISK_SCORE_RULES = [
+    ('age', '>', 60, 2),
+    ('sex', '=', 'Male', 1),
+    ('chest_pain_type', '=', 'Asymptomatic', 2),
+    ('resting_blood_pressure', '>', 140, 2),
+    ('cholesterol', '>', 240, 2),
+    ('fasting_blood_sugar_high', '=', True, 1),
+    ('max_heart_rate', '<', 120, 2),
+    ('exercise_induced_angina', '=', True, 2),
+    ('st_depression', '>', 2.0, 2),
+    ('num_major_vessels', '>=', 2, 2)
+]
+# Optional JSON file with a list of [column, operator, threshold, weight] rules replacing the above
+RISK_SCORE_RULES_FILE = os.getenv("RISK_SCORE_RULES_FILE")
+# Optional user-supplied scorer as "module:function", see src/Scoring.py
+RISK_SCORER = os.getenv("RISK_SCORER")
+
+#Column Profiling
+
+PROFILE_TOP_K = 5
+PROFILE_HISTOGRAM_BUCKETS = 10
+
 #Column Descriptions
 
 COLUMN_DESCRIPTIONS = {
@@ -52,21 +150,111 @@ COLUMN_DESCRIPTIONS = {
     'num': 'Diagnosis of heart disease (0=no disease, 1-4=disease severity)'
 }
 
+#Datasets
+
+# The runner gives each dataset a schema of its name, these are DuckDB's own schemas and catalogs
+RESERVED_DATASET_NAMES = ('main', 'temp', 'system', 'information_schema', 'pg_catalog')
+
+
+class DatasetConfig:
+    """Source and warehouse locations of one dataset, so several can run in one process"""
+
+    def __init__(self, name, source_bucket=None, source_key=None, target_bucket=None, target_base_file=None):
+        if not name.replace('_', '').isalnum():
+            raise ValueError("Dataset name must be alphanumeric with underscores: " + name)
+        if name.lower() in RESERVED_DATASET_NAMES:
+            raise ValueError("Dataset name is reserved by DuckDB: " + name)
+        self.name = name
+        self.source_bucket = source_bucket or SOURCE_BUCKET
+        self.source_key = source_key or SOURCE_KEY
+        self.target_bucket = target_bucket or TARGET_BUCKET
+        # Only the default dataset writes directly under TARGET_BASE_FILE, others get their own folder
+        self.target_base_file = target_base_file or (TARGET_BASE_FILE if name == 'default' else TARGET_BASE_FILE + "/" + name)
+        self.bronze_prefix = self.target_base_file + "/Bronze/"
+        self.silver_prefix = self.target_base_file + "/Silver/"
+        self.gold_prefix = self.target_base_file + "/Gold/"
+
+
+def get_default_dataset():
+    """Dataset described by the module-level source and target settings"""
+    return DatasetConfig('default', SOURCE_BUCKET, SOURCE_KEY, TARGET_BUCKET, TARGET_BASE_FILE)
+
+
+def load_dataset_configs(path):
+    """Load a JSON list of datasets: name, source_key and optionally source_bucket, target_bucket, target_base_file.
+
+    target_base_file defaults to TARGET_BASE_FILE/<name>.
+    """
+    with open(path) as f:
+        entries = json.load(f)
+    datasets = [DatasetConfig(**entry) for entry in entries]
+    names = [dataset.name for dataset in datasets]
+    if len(set(names)) != len(names):
+        raise ValueError("Dataset names must be unique in " + path)
+    locations = [(dataset.target_bucket, dataset.target_base_file.rstrip('/')) for dataset in datasets]
+    if len(set(locations)) != len(locations):
+        raise ValueError("Datasets must not share a target_bucket and target_base_file in " + path)
+    return datasets
+
 #Validation
 
-def validate_config():
-    """Check if all required configuration values are set"""
+class JsonLogFormatter(logging.Formatter):
+    """One JSON object per record, with any `extra` fields as top-level keys"""
+
+    STANDARD_ATTRIBUTES = set(vars(logging.LogRecord('', 0, '', 0, '', None, None))) | {'message', 'asctime'}
+
+    def format(self, record):
+        document = {
+            'time': self.formatTime(record, '%Y-%m-%dT%H:%M:%S'),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage()
+        }
+        document.update((key, value) for key, value in vars(record).items() if key not in self.STANDARD_ATTRIBUTES)
+        if record.exc_info:
+            document['exception'] = self.formatException(record.exc_info)
+        return json.dumps(document, default=str)
+
+
+def configure_logging(level=None, log_format=None):
+    """Send all log records to stdout, as text lines or JSON lines"""
+    handler = logging.StreamHandler(sys.stdout)
+    if (log_format or LOG_FORMAT) == 'json':
+        handler.setFormatter(JsonLogFormatter())
+    else:
+        handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)-7s %(name)s: %(message)s', '%H:%M:%S'))
+    root = logging.getLogger()
+    root.handlers = [handler]
+    root.setLevel((level or LOG_LEVEL).upper())
+    # Keep library chatter out of the pipeline's output
+    for library in ('botocore', 'boto3', 's3transfer', 'urllib3'):
+        logging.getLogger(library).setLevel(logging.WARNING)
+
+
+def validate_config(layer=None):
+    """Check if all required configuration values are set, plus those `layer` needs when given"""
     errors = []
     
-    if not AWS_ACCESS_KEY_ID:
+    if STORAGE_BACKEND not in ('s3', 'local'):
+        errors.append("STORAGE_BACKEND must be 's3' or 'local'")
+    if STORAGE_BACKEND == 's3' and not AWS_ACCESS_KEY_ID:
         errors.append("AWS_ACCESS_KEY_ID not set")
-    if not AWS_SECRET_ACCESS_KEY:
+    if STORAGE_BACKEND == 's3' and not AWS_SECRET_ACCESS_KEY:
         errors.append("AWS_SECRET_ACCESS_KEY not set")
+    if STORAGE_BACKEND == 'local' and not LOCAL_STORAGE_ROOT:
+        errors.append("LOCAL_STORAGE_ROOT not set")
     if not SOURCE_BUCKET:
         errors.append("SOURCE_BUCKET not set")
     if not TARGET_BUCKET:
         errors.append("TARGET_BUCKET not set")
     
+    if METADATA_MAX_CONCURRENCY > S3_MAX_POOL_CONNECTIONS:
+        errors.append("METADATA_MAX_CONCURRENCY must not exceed S3_MAX_POOL_CONNECTIONS")
+    if STREAM_MAX_WAIT_SECONDS >= STREAM_LATENCY_TARGET_SECONDS:
+        errors.append("STREAM_MAX_WAIT_SECONDS must be below STREAM_LATENCY_TARGET_SECONDS")
+    if layer == 'stream' and DUCKDB_DATABASE == ':memory:':
+        errors.append("DUCKDB_DATABASE must be a database file for the stream layer, it records the processed landing files")
+    
     if MIN_AGE < 0 or MAX_AGE > 150:
         errors.append("Age constraints out of reasonable range")
     if MIN_BLOOD_PRESSURE < 0 or MAX_BLOOD_PRESSURE > 300:
@@ -84,6 +272,14 @@ def get_s3_path():
     return "s3://" + SOURCE_BUCKET + "/" + SOURCE_KEY
 
 
+def get_risk_score_rules():
+    """Get the weighted risk-score rules, from RISK_SCORE_RULES_FILE when set"""
+    if not RISK_SCORE_RULES_FILE:
+        return [tuple(rule) for rule in RISK_SCORE_RULES]
+    with open(RISK_SCORE_RULES_FILE) as f:
+        return [tuple(rule) for rule in json.load(f)]
+
+
 def get_quality_rules():
     """Get all data quality rules as a dictionary"""
     return {
@@ -101,22 +297,18 @@ def get_quality_rules():
 
 
 def print_config_summary():
-    """Print configuration summary"""
-    print("\n" + "="*70)
-    print("CONFIGURATION SUMMARY")
-    print("="*70)
-    print("AWS Region: " + str(AWS_REGION))
-    print("Source: s3://" + SOURCE_BUCKET + "/" + SOURCE_KEY)
-    print("Warehouse: s3://" + TARGET_BUCKET + "/" + TARGET_BASE_FILE + "/")
-    print("  - Bronze: " + BRONZE_PREFIX)
-    print("  - Silver: " + SILVER_PREFIX)
-    print("  - Gold: " + GOLD_PREFIX)
-    print("\nFull S3 Paths:")
-    print("  - Bronze: s3://" + TARGET_BUCKET + "/" + BRONZE_PREFIX)
-    print("  - Silver: s3://" + TARGET_BUCKET + "/" + SILVER_PREFIX)
-    print("  - Gold: s3://" + TARGET_BUCKET + "/" + GOLD_PREFIX)
-    print("\nData Quality Rules:")
-    print("  - Age: " + str(MIN_AGE) + "-" + str(MAX_AGE) + " years")
-    print("  - Blood Pressure: " + str(MIN_BLOOD_PRESSURE) + "-" + str(MAX_BLOOD_PRESSURE) + " mmHg")
-    print("  - Cholesterol: " + str(MIN_CHOLESTEROL) + "-" + str(MAX_CHOLESTEROL) + " mg/dL")
-    print("="*70 + "\n")
\ No newline at end of file
+    """Log configuration summary"""
+    logger = logging.getLogger(__name__)
+    logger.info("Configuration summary:\n" + "\n".join([
+        "Storage Backend: " + STORAGE_BACKEND + (" (" + str(LOCAL_STORAGE_ROOT) + ")" if STORAGE_BACKEND == 'local' else ""),
+        "AWS Region: " + str(AWS_REGION),
+        "Source: s3://" + SOURCE_BUCKET + "/" + SOURCE_KEY,
+        "Warehouse: s3://" + TARGET_BUCKET + "/" + TARGET_BASE_FILE + "/",
+        "  - Bronze: " + BRONZE_PREFIX,
+        "  - Silver: " + SILVER_PREFIX,
+        "  - Gold: " + GOLD_PREFIX,
+        "Data Quality Rules:",
+        "  - Age: " + str(MIN_AGE) + "-" + str(MAX_AGE) + " years",
+        "  - Blood Pressure: " + str(MIN_BLOOD_PRESSURE) + "-" + str(MAX_BLOOD_PRESSURE) + " mmHg",
+        "  - Cholesterol: " + str(MIN_CHOLESTEROL) + "-" + str(MAX_CHOLESTEROL) + " mg/dL"
+    ]))
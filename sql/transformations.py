@@ -2,13 +2,82 @@
 
 #Bronze Layer
 
+# Source rows are staged once with a 128-bit content hash (the raw md5) over the CSV columns.
+# With n distinct rows in the hash index the chance of any false duplicate is about
+# n^2 / 2^129, around 1e-27 for a million rows.
+BRONZE_STAGE_SOURCE = """
+CREATE OR REPLACE TEMP TABLE bronze_staging AS
+SELECT
+    * EXCLUDE (filename),
+    {fingerprint} AS row_fingerprint,
+    filename AS source_file
+FROM read_csv_auto($csv_paths, Header=True, filename=True)"""
+
+# {distinct} and {anti_join} are empty when deduplication is disabled
 BRONZE_CREATE_TABLE = """
 CREATE TABLE IF NOT EXISTS bronze_heart_disease AS
+SELECT {distinct}
+    staged.* EXCLUDE (source_file),
+    CURRENT_TIMESTAMP AS ingestion_timestamp,
+    COALESCE($source_file, staged.source_file) AS source_file
+FROM bronze_staging staged
+{anti_join}"""
+
+BRONZE_EMPTY_TABLE = """
+CREATE TABLE IF NOT EXISTS bronze_heart_disease AS
+SELECT * FROM read_parquet([{files}])
+LIMIT 0"""
+
+BRONZE_DEDUP_DISTINCT = "DISTINCT ON (staged.row_fingerprint)"
+
+BRONZE_DEDUP_ANTI_JOIN = "ANTI JOIN {seen_table} {alias} ON staged.row_fingerprint = {alias}.{seen_column}"
+
+BRONZE_SEEN_FINGERPRINTS_EMPTY = """
+CREATE OR REPLACE TEMP TABLE bronze_seen_fingerprints (fingerprint BLOB)"""
+
+BRONZE_NEW_FINGERPRINTS = """
+SELECT DISTINCT row_fingerprint AS fingerprint
+FROM bronze_heart_disease
+{where}
+ORDER BY fingerprint"""
+
+# Batches of the stored Bronze snapshot that no Silver row came from yet, i.e. left by a
+# Bronze-only run or a run that failed after exporting Bronze. Batches of this run are
+# already in bronze_heart_disease; {absorbed} is empty when there is no Silver snapshot.
+# Only the ingestion_timestamp column is read to find them.
+BRONZE_UNABSORBED_BATCHES = """
+CREATE OR REPLACE TEMP TABLE bronze_unabsorbed_batches AS
+SELECT DISTINCT ingestion_timestamp FROM read_parquet([{files}])
+EXCEPT
+SELECT ingestion_timestamp FROM bronze_heart_disease{absorbed}"""
+
+BRONZE_ABSORBED_BATCHES = """
+EXCEPT
+SELECT ingestion_timestamp FROM read_parquet([{files}])"""
+
+BRONZE_LOAD_UNABSORBED = """
+INSERT INTO bronze_heart_disease BY NAME
+SELECT * FROM read_parquet([{files}])
+WHERE ingestion_timestamp IN (SELECT ingestion_timestamp FROM bronze_unabsorbed_batches)"""
+
+# Micro-batches: the table is created empty from the first batch's schema, then
+# every batch is appended with the landing file it came from as source_file.
+BRONZE_BATCH_CREATE_TABLE = """
+CREATE TABLE IF NOT EXISTS bronze_heart_disease AS
 SELECT
-    *,
+    * EXCLUDE (source_file),
     CURRENT_TIMESTAMP AS ingestion_timestamp,
-    $source_file AS source_file
-FROM read_csv_auto($csv_path, Header=True)"""
+    source_file
+FROM bronze_staging
+LIMIT 0"""
+
+BRONZE_APPEND_BATCH = """
+INSERT INTO bronze_heart_disease BY NAME
+SELECT {distinct}
+    staged.*,
+    CURRENT_TIMESTAMP AS ingestion_timestamp
+FROM bronze_staging staged
+{anti_join}"""
 
 #Silver Layer
 
@@ -137,13 +206,46 @@ FROM silver_stage2_standardized """
 
 # Final Silver Layer
 
+# {order_by} clusters the table on SILVER_CLUSTER_KEYS; DuckDB keeps insertion order,
+# so its row groups and the exported Parquet row groups get narrow min/max ranges.
 SILVER_FINAL_TABLE = """
 CREATE TABLE IF NOT EXISTS silver_heart_disease AS
 SELECT * FROM silver_stage3_validated
-WHERE has_quality_issues = FALSE """
+WHERE has_quality_issues = FALSE {order_by} """
+
+# Deduplicated runs hold only new rows; the previous Silver snapshot is merged in so Gold
+# sees the full data. Rows of this run carry the ingestion_timestamp of this run's Bronze.
+SILVER_MERGE_PREVIOUS = """
+CREATE OR REPLACE TABLE silver_heart_disease AS
+SELECT * FROM (
+    SELECT * FROM read_parquet([{files}])
+    UNION ALL BY NAME
+    SELECT * FROM silver_heart_disease
+) {order_by} """
+
+SILVER_LOAD_SNAPSHOT = """
+CREATE OR REPLACE TABLE silver_heart_disease AS
+SELECT * FROM read_parquet([{files}])"""
+
+SILVER_NEW_ROWS = "ingestion_timestamp IN (SELECT DISTINCT ingestion_timestamp FROM bronze_heart_disease)"
+
+# Runs in the same transaction as BRONZE_APPEND_BATCH; CURRENT_TIMESTAMP is fixed per
+# transaction, so it only matches the rows of this batch even when a file is re-sent.
+SILVER_APPEND_BATCH = """
+INSERT INTO silver_heart_disease BY NAME
+SELECT * FROM silver_stage3_validated
+WHERE has_quality_issues = FALSE
+  AND source_file IN (SELECT UNNEST($source_files))
+  AND ingestion_timestamp = CURRENT_TIMESTAMP """
 
 #Gold Layer
 
+# Gold-only runs read the exported Silver Parquet through a view, so DuckDB pushes
+# each Gold query's column projection and filters down into the Parquet scan.
+GOLD_SILVER_PARQUET_SOURCE = """
+CREATE OR REPLACE VIEW silver_heart_disease AS
+SELECT * FROM read_parquet('{parquet_path}') """
+
 GOLD_DEMO_SUMMARY = """
 CREATE TABLE IF NOT EXISTS gold_demographics_summary AS
 SELECT 
@@ -232,40 +334,162 @@ FROM silver_heart_disease
 GROUP BY dataset, sex
 ORDER BY dataset, sex """
 
+# {risk_score} is filled in by the risk-scoring stage (src/Scoring.py)
+# Star schema: (table, surrogate key, Silver columns it is keyed on, derived attributes)
+GOLD_DIMENSIONS = [
+    ('gold_dim_demographics', 'demographics_key', ['sex', 'age_group'], {}),
+    ('gold_dim_chest_pain', 'chest_pain_key', ['chest_pain_type'], {}),
+    ('gold_dim_ecg', 'ecg_key', ['resting_ecg'], {}),
+    ('gold_dim_slope', 'slope_key', ['st_slope'], {}),
+    ('gold_dim_thalassemia', 'thalassemia_key', ['thalassemia'], {}),
+    ('gold_dim_dataset', 'dataset_key', ['dataset'], {}),
+    ('gold_dim_heart_rate', 'heart_rate_key', ['max_heart_rate_category'], {}),
+    ('gold_dim_severity', 'severity_key', ['heart_disease_severity', 'has_heart_disease'], {
+        'severity_label': """CASE
+            WHEN heart_disease_severity = 0 THEN 'No Disease'
+            WHEN heart_disease_severity = 1 THEN 'Mild'
+            WHEN heart_disease_severity = 2 THEN 'Moderate'
+            WHEN heart_disease_severity = 3 THEN 'Severe'
+            WHEN heart_disease_severity = 4 THEN 'Very Severe'
+        END"""
+    })
+]
+
+# Members of the previous version keep their keys, and are kept even when the current
+# Silver no longer has them, so a key is never reused. New members are numbered after
+# the largest existing key. {previous} is the previous version, or an empty set.
+GOLD_DIMENSION_TABLE = """
+CREATE OR REPLACE TABLE {dimension} AS
+WITH members AS (
+    SELECT DISTINCT {columns}{derived}
+    FROM silver_heart_disease
+),
+previous AS (
+    {previous}
+),
+new_members AS (
+    SELECT m.* FROM members m
+    ANTI JOIN previous p ON {match}
+)
+SELECT * FROM previous
+UNION ALL BY NAME
+SELECT
+    CAST((SELECT COALESCE(MAX({key}), 0) FROM previous) + ROW_NUMBER() OVER (ORDER BY {columns}) AS INTEGER) AS {key},
+    *
+FROM new_members
+ORDER BY {key} """
+
+GOLD_DIMENSION_NO_PREVIOUS = "SELECT CAST(NULL AS INTEGER) AS {key}, * FROM members WHERE FALSE"
+
+GOLD_DIMENSION_JOIN = "JOIN {dimension} ON {match}"
+
+# Narrow fact: surrogate keys and measures only, the descriptive strings live in the
+# dimensions. The risk score is computed before the joins, from Silver columns.
 GOLD_POWERBI_FACT_TABLE = """
 CREATE TABLE IF NOT EXISTS gold_powerbi_fact_table AS
+WITH scored AS (
+    SELECT *, {risk_score} AS calculated_risk_score
+    FROM silver_heart_disease
+)
 SELECT 
-    patient_id,
-    age,
+    s.patient_id,
+    {dimension_keys},
+    s.age,
+    s.resting_blood_pressure,
+    s.cholesterol,
+    s.fasting_blood_sugar_high,
+    s.max_heart_rate,
+    s.exercise_induced_angina,
+    s.st_depression,
+    s.num_major_vessels,
+    s.calculated_risk_score
+FROM scored s
+{dimension_joins} {order_by} """
+
+#OLAP Cube
+
+# Additive measures only (counts and sums), so any slice of the cube can be
+# re-aggregated with SUM and averages derived as sum / count.
+CUBE_DIMENSIONS = ['sex', 'age_group', 'dataset', 'chest_pain_type', 'thalassemia', 'heart_disease_severity']
+
+GOLD_CUBE = """
+CREATE TABLE IF NOT EXISTS gold_cube AS
+SELECT 
+    GROUPING(sex, age_group, dataset, chest_pain_type, thalassemia, heart_disease_severity) AS grouping_id,
     sex,
     age_group,
     dataset,
     chest_pain_type,
-    resting_blood_pressure,
-    cholesterol,
-    fasting_blood_sugar_high,
-    resting_ecg,
-    max_heart_rate,
-    max_heart_rate_category,
-    exercise_induced_angina,
-    st_depression,
-    st_slope,
-    num_major_vessels,
     thalassemia,
     heart_disease_severity,
-    has_heart_disease,
-    (CASE WHEN age > 60 THEN 2 ELSE 0 END + CASE WHEN sex = 'Male' THEN 1 ELSE 0 END + 
-    CASE WHEN chest_pain_type = 'Asymptomatic' THEN 2 ELSE 0 END +
-    CASE WHEN resting_blood_pressure > 140 THEN 2 ELSE 0 END + CASE WHEN cholesterol > 240 THEN 2 ELSE 0 END +
-    CASE WHEN fasting_blood_sugar_high THEN 1 ELSE 0 END +
-    CASE WHEN max_heart_rate < 120 THEN 2 ELSE 0 END +
-    CASE WHEN exercise_induced_angina THEN 2 ELSE 0 END +
-    CASE WHEN st_depression > 2.0 THEN 2 ELSE 0 END +
-    CASE WHEN num_major_vessels >= 2 THEN 2 ELSE 0 END 
-    ) AS calculated_risk_score,
-    
+    COUNT(*) AS patient_count,
+    COUNT(CASE WHEN has_heart_disease THEN 1 END) AS heart_disease_count,
+    SUM(age) AS sum_age,
+    COUNT(age) AS count_age,
+    SUM(resting_blood_pressure) AS sum_blood_pressure,
+    COUNT(resting_blood_pressure) AS count_blood_pressure,
+    SUM(cholesterol) AS sum_cholesterol,
+    COUNT(cholesterol) AS count_cholesterol,
+    SUM(max_heart_rate) AS sum_max_heart_rate,
+    COUNT(max_heart_rate) AS count_max_heart_rate,
+    SUM(st_depression) AS sum_st_depression,
+    COUNT(st_depression) AS count_st_depression,
+    COUNT(CASE WHEN fasting_blood_sugar_high THEN 1 END) AS high_fasting_sugar_count,
+    COUNT(CASE WHEN exercise_induced_angina THEN 1 END) AS exercise_angina_count,
     CURRENT_TIMESTAMP AS created_at
-FROM silver_heart_disease """
+FROM silver_heart_disease
+GROUP BY CUBE (sex, age_group, dataset, chest_pain_type, thalassemia, heart_disease_severity)
+ORDER BY grouping_id """
+
+# Measure name -> (expression over gold_cube rows, equivalent expression over silver_heart_disease)
+# Counts are cast back to BIGINT, SUM over BIGINT returns HUGEINT
+CUBE_MEASURES = {
+    'patient_count': ("CAST(SUM(patient_count) AS BIGINT)", "COUNT(*)"),
+    'heart_disease_count': ("CAST(SUM(heart_disease_count) AS BIGINT)", "COUNT(CASE WHEN has_heart_disease THEN 1 END)"),
+    'heart_disease_percentage': (
+        "ROUND(SUM(heart_disease_count) * 100.0 / SUM(patient_count), 2)",
+        "ROUND(COUNT(CASE WHEN has_heart_disease THEN 1 END) * 100.0 / COUNT(*), 2)"),
+    'avg_age': ("SUM(sum_age) / SUM(count_age)", "AVG(age)"),
+    'avg_blood_pressure': ("SUM(sum_blood_pressure) / SUM(count_blood_pressure)", "AVG(resting_blood_pressure)"),
+    'avg_cholesterol': ("SUM(sum_cholesterol) / SUM(count_cholesterol)", "AVG(cholesterol)"),
+    'avg_max_heart_rate': ("SUM(sum_max_heart_rate) / SUM(count_max_heart_rate)", "AVG(max_heart_rate)"),
+    'avg_st_depression': ("SUM(sum_st_depression) / SUM(count_st_depression)", "AVG(st_depression)"),
+    'high_fasting_sugar_count': ("CAST(SUM(high_fasting_sugar_count) AS BIGINT)", "COUNT(CASE WHEN fasting_blood_sugar_high THEN 1 END)"),
+    'exercise_angina_count': ("CAST(SUM(exercise_angina_count) AS BIGINT)", "COUNT(CASE WHEN exercise_induced_angina THEN 1 END)")
+}
+
+# Non-additive measures, always answered from silver_heart_disease
+SILVER_ONLY_MEASURES = {
+    'median_blood_pressure': "PERCENTILE_CONT(0.5) WITHIN GROUP (ORDER BY resting_blood_pressure)",
+    'median_cholesterol': "PERCENTILE_CONT(0.5) WITHIN GROUP (ORDER BY cholesterol)",
+    'median_max_heart_rate': "PERCENTILE_CONT(0.5) WITHIN GROUP (ORDER BY max_heart_rate)",
+    'unique_patients': "COUNT(DISTINCT patient_id)"
+}
+
+#Streaming State
+
+STREAM_PROCESSED_FILES_TABLE = """
+CREATE TABLE IF NOT EXISTS stream_processed_files (
+    file_key VARCHAR,
+    etag VARCHAR,
+    size_bytes BIGINT,
+    batch_id INTEGER,
+    processed_at TIMESTAMP
+) """
+
+STREAM_BATCH_METRICS_TABLE = """
+CREATE TABLE IF NOT EXISTS stream_batch_metrics (
+    batch_id INTEGER,
+    file_count INTEGER,
+    batch_bytes BIGINT,
+    bronze_rows BIGINT,
+    silver_rows BIGINT,
+    processing_seconds DOUBLE,
+    end_to_end_latency_seconds DOUBLE,
+    pending_files INTEGER,
+    lag_seconds DOUBLE,
+    completed_at TIMESTAMP
+) """
 
 #Utility Queries
 
@@ -321,32 +545,83 @@ FROM gold_powerbi_fact_table
 DATA_QUALITY_REPORT = """
 SELECT 
     'Total Records' AS metric,
-     COUNT(*) AS value
-FROM bronze_heart_disease
+     MAX(row_count) AS value
+FROM bronze_profile
 
 UNION ALL
 
 SELECT 
     'Records with Quality Issues' AS metric,
-     COUNT(*) AS value
-FROM silver_stage3_validated
-WHERE has_quality_issues = TRUE
+     (SELECT MAX(row_count) FROM bronze_profile) - MAX(row_count) AS value
+FROM silver_profile
 
 UNION ALL
 
 SELECT 
     'Clean Records in Silver' AS metric,
-     COUNT(*) AS value
-FROM silver_heart_disease
+     MAX(row_count) AS value
+FROM silver_profile
 
 UNION ALL
 
 SELECT 
     'Null Values in Critical Fields' AS metric,
-     COUNT(*) AS value
-FROM bronze_heart_disease
-WHERE age IS NULL 
-   OR sex IS NULL 
-   OR trestbps IS NULL 
-   OR chol IS NULL
-"""
\ No newline at end of file
+     MAX(critical_null_rows) AS value
+FROM bronze_profile
+"""
+
+#Profiling
+
+# One row per column of the profiled table, computed in a single scan. The
+# per-column struct entries are generated from PROFILE_COLUMN_STATS; row-level
+# counts from PROFILE_ROW_CHECK are repeated on every row.
+PROFILE_CREATE_TABLE = """
+CREATE OR REPLACE TABLE {profile_table} AS
+SELECT
+    '{layer}' AS layer,
+    UNNEST(column_stats, recursive := true),{row_check_columns}
+    CURRENT_TIMESTAMP AS profiled_at
+FROM (
+    SELECT [{column_stats}
+    ] AS column_stats{row_checks}
+    FROM {source_table}
+) """
+
+PROFILE_ROW_CHECK = "COUNT(*) FILTER (WHERE {predicate}) AS {name}"
+
+# Bronze rows missing any field the Silver quality rules depend on
+BRONZE_CRITICAL_NULL_ROWS = "age IS NULL OR sex IS NULL OR trestbps IS NULL OR chol IS NULL"
+
+PROFILE_COLUMN_STATS = """
+        {{
+            'column_name': '{column_name}',
+            'column_type': '{column_type}',
+            'row_count': COUNT(*),
+            'null_count': COUNT(*) - COUNT({column}),
+            'min_value': CAST(MIN({column}) AS VARCHAR),
+            'max_value': CAST(MAX({column}) AS VARCHAR),
+            'approx_distinct': approx_count_distinct({column}),
+            'quantiles': {quantiles},
+            'value_counts': {value_counts},
+            'top_values': approx_top_k(CAST({column} AS VARCHAR), {top_k})
+        }}"""
+
+PROFILE_QUANTILES = "CAST(approx_quantile({column}, {fractions}) AS DOUBLE[])"
+PROFILE_VALUE_COUNTS = "CAST(histogram(CAST({column} AS VARCHAR)) AS MAP(VARCHAR, BIGINT))"
+PROFILE_NO_QUANTILES = "CAST(NULL AS DOUBLE[])"
+PROFILE_NO_VALUE_COUNTS = "CAST(NULL AS MAP(VARCHAR, BIGINT))"
+
+PROFILE_VALUE_DISTRIBUTION = """
+SELECT
+    UNNEST(map_keys(value_counts)) AS value,
+    UNNEST(map_values(value_counts)) AS count
+FROM {profile_table}
+WHERE column_name = ?
+ORDER BY value """
+
+BRONZE_PROFILE_STATS = """
+SELECT
+    MAX(row_count) AS Total_Records,
+    MAX(CASE WHEN column_name = 'id' THEN approx_distinct END) AS Approx_Unique_Patients,
+    MAX(CASE WHEN column_name = 'ingestion_timestamp' THEN min_value END) AS Ingestion_Time
+FROM bronze_profile """
@@ -1,7 +1,7 @@
 #Bronze Layer -- Raw data Ingestion
 
 import duckdb
-import boto3
+import logging
 from datetime import datetime
 from dotenv import load_dotenv
 import os
@@ -9,95 +9,275 @@ import sys
 import tempfile
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 import config
-from sql.transformations import BRONZE_CREATE_TABLE
+from sql.transformations import (BRONZE_STAGE_SOURCE, BRONZE_CREATE_TABLE, BRONZE_DEDUP_DISTINCT, BRONZE_DEDUP_ANTI_JOIN,
+                                 BRONZE_SEEN_FINGERPRINTS_EMPTY, BRONZE_NEW_FINGERPRINTS, BRONZE_BATCH_CREATE_TABLE,
+                                 BRONZE_APPEND_BATCH, BRONZE_UNABSORBED_BATCHES, BRONZE_ABSORBED_BATCHES, BRONZE_LOAD_UNABSORBED,
+                                 BRONZE_EMPTY_TABLE,
+                                 BRONZE_PROFILE_STATS)
+from Profile import ProfileLayer
+from storage import get_storage
+from metadata import ObjectMetadata
+from snapshot import SnapshotTable
+
+logger = logging.getLogger(__name__)
+
+
+def _file_list(uris):
+    return ", ".join("'" + uri.replace("'", "''") + "'" for uri in uris)
 
 
 class BronzeLayer:
-    def __init__(self):
-        self.conn = None
+    def __init__(self, storage=None, database=None, dataset=None, conn=None):
+        # A connection passed in is expected to be configured for the storage backend already
+        self.conn = conn
+        self.storage = storage or get_storage()
+        self.database = database or config.DUCKDB_DATABASE
+        self.dataset = dataset or config.get_default_dataset()
+        self.deduplicate = config.BRONZE_DEDUPLICATE
+        self.duplicates_dropped = 0
+        self.record_count = None
+        self.unabsorbed_count = 0
+        self.index_loaded = False
+        self.metadata = ObjectMetadata(self.storage)
+        self.source_entries = []
+        self.unchanged_entries = []
     
-    def validation_of_S3_path(self, bucket, key):
-        s3 = boto3.client('s3')
-        try:
-            s3.head_object(Bucket=bucket, Key=key)
-            return True
-        except Exception as e:
-            print("Error accessing S3 path: {}".format(str(e)))
-            return False
-        
     def _init_duckdb(self):
-        self.conn = duckdb.connect(':memory:')
-        self.conn.execute('INSTALL httpfs')
-        self.conn.execute('LOAD httpfs')
-
-        if not config.AWS_ACCESS_KEY_ID or not isinstance(config.AWS_ACCESS_KEY_ID, str):
-            raise ValueError("AWS_ACCESS_KEY_ID must be set in the config file.")
-        if not config.AWS_SECRET_ACCESS_KEY or not isinstance(config.AWS_SECRET_ACCESS_KEY, str):
-            raise ValueError("AWS_SECRET_ACCESS_KEY must be set in the config file.")
-        if not config.AWS_REGION or not isinstance(config.AWS_REGION, str):
-            raise ValueError("Invalid AWS region configuration")
-        
-        self.conn.execute("""
-            CREATE SECRET AWS_credentials (
-                          TYPE S3,
-                          KEY_ID ?,
-                          SECRET ?,
-                          REGION ?
-            )
-        """, [config.AWS_ACCESS_KEY_ID, config.AWS_SECRET_ACCESS_KEY, config.AWS_REGION])
-        print("DuckDB initialized with AWS credentials.")
+        self.conn = duckdb.connect(self.database)
+        self.storage.configure_duckdb(self.conn)
+        logger.info("DuckDB initialized for the {} storage backend.".format(self.storage.name))
+        return self.conn
+
+    def init_connection(self):
+        if self.conn is None:
+            self._init_duckdb()
+        return self.conn
     
+    def plan_sources(self):
+        """Resolve the dataset's source into CSV objects with their size and ETag.
+
+        source_key is one key, a comma-separated list of keys, or prefixes ending in '/'.
+        All HEAD and LIST calls run concurrently, missing keys fail the run up front.
+        With deduplication, objects whose ETag is unchanged since their rows went into the
+        fingerprint index are left out: every row of them would be dropped as a duplicate.
+        """
+        bucket = self.dataset.source_bucket
+        parts = [part.strip() for part in self.dataset.source_key.split(',') if part.strip()]
+        prefixes = [part for part in parts if part.endswith('/')]
+        keys = [part for part in parts if not part.endswith('/')]
+
+        entries = []
+        for listing in self.metadata.list_prefixes(bucket, prefixes).values():
+            entries += [entry for entry in listing if entry['key'].lower().endswith('.csv')]
+        heads = self.metadata.head_many(bucket, keys)
+        missing = [key for key in keys if heads[key] is None]
+        if missing:
+            raise ValueError("Source objects not found: " + ", ".join(self.storage.uri(bucket, key) for key in missing))
+        entries += [heads[key] for key in keys]
+
+        # Empty objects have no header for read_csv_auto to sniff
+        self.source_entries = sorted(dict((entry['key'], entry) for entry in entries if entry['size'] > 0).values(),
+                                     key=lambda entry: entry['key'])
+        if not self.source_entries:
+            raise ValueError("No CSV source data found for " + self.storage.uri(bucket, self.dataset.source_key))
+
+        covered = self._covered_sources() if self.deduplicate else {}
+        self.unchanged_entries = [entry for entry in self.source_entries
+                                  if entry['etag'] and covered.get(self.storage.uri(bucket, entry['key'])) == entry['etag']]
+        if self.unchanged_entries:
+            unchanged_keys = set(entry['key'] for entry in self.unchanged_entries)
+            self.source_entries = [entry for entry in self.source_entries if entry['key'] not in unchanged_keys]
+            logger.info("Skipping {} source objects unchanged since they were ingested.".format(str(len(self.unchanged_entries))))
+        return self.source_entries
+
+    def _covered_sources(self):
+        """URI -> ETag of the source objects whose rows are all in the fingerprint index"""
+        bronze = SnapshotTable("bronze_heart_disease", self.dataset.bronze_prefix, self.storage, self.dataset.target_bucket)
+        fingerprints = self.fingerprints()
+        # Without a Bronze snapshot there is no schema for a run that reads nothing
+        if bronze.pointer() is None or fingerprints.pointer() is None:
+            return {}
+        return fingerprints.manifest().get('properties', {}).get('source_etags', {})
+
+    def fingerprints(self):
+        """Snapshot table holding the content hash of every row already in Bronze"""
+        return SnapshotTable("bronze_fingerprints", self.dataset.bronze_prefix, self.storage, self.dataset.target_bucket)
+
+    def _stage_source(self, csv_paths):
+        # Hash the source columns only, so the same row from another file or run hashes the same.
+        # md5 over the values as text is stable across DuckDB versions and column types, and
+        # kept as its 16 raw bytes rather than 32 hex characters.
+        description = self.conn.execute("SELECT * FROM read_csv_auto(?, Header=True) LIMIT 0",
+                                        [csv_paths if isinstance(csv_paths, str) else csv_paths[0]]).description
+        columns = ["COALESCE(CAST(\"" + column[0].replace('"', '""') + "\" AS VARCHAR), '\\N')" for column in description]
+        fingerprint = "unhex(md5(concat_ws(chr(31), " + ", ".join(columns) + ")))"
+        result = self.conn.execute(BRONZE_STAGE_SOURCE.format(fingerprint=fingerprint),
+                                   {'csv_paths': csv_paths}).fetchone()
+        return result[0] if result else 0
+
+    def _load_seen_fingerprints(self):
+        table = self.fingerprints()
+        try:
+            if table.pointer() is not None:
+                uris = table.attach(self.conn, 'bronze_seen_fingerprints')
+                logger.info("Loaded the row fingerprint index from {} files.".format(str(len(uris))))
+                return
+        except ValueError:
+            pass
+        self.conn.execute(BRONZE_SEEN_FINGERPRINTS_EMPTY)
+
+    def _dedup_clauses(self, *seen):
+        """DISTINCT and anti-join clauses against each (table, fingerprint column) in `seen`"""
+        if not self.deduplicate:
+            return {'distinct': '', 'anti_join': ''}
+        return {
+            'distinct': BRONZE_DEDUP_DISTINCT,
+            'anti_join': "\n".join(
+                BRONZE_DEDUP_ANTI_JOIN.format(seen_table=seen_table, seen_column=seen_column, alias="seen_" + str(i))
+                for i, (seen_table, seen_column) in enumerate(seen))
+        }
+
     def raw_data_ingestion(self):
-        self._init_duckdb()
-        if not self.validation_of_S3_path(config.SOURCE_BUCKET, config.SOURCE_KEY):
-            raise ValueError("Invalid S3 path for source data.")
-        
-        s3_path = config.get_s3_path()
-        print("Reading Raw data from S3 path: " + s3_path)
-
-        self.conn.execute(
-            BRONZE_CREATE_TABLE,
-            {
-                'csv_path': s3_path,
-                'source_file': config.SOURCE_KEY
-            }
-        )
-
-        result = self.conn.execute("SELECT COUNT(*) AS record_count FROM bronze_heart_disease").fetchone()
-        record_count = result[0] if result else 0
-        print("Raw data ingestion completed. Total records ingested: {}".format(str(record_count)))
-        print("Sample records from the first 5 rows:" + str(self.conn.execute("SELECT * FROM bronze_heart_disease LIMIT 5").fetchdf()))
+        self.init_connection()
+        entries = self.plan_sources()
+        if not entries:
+            return self._ingest_nothing()
+        s3_paths = [self.storage.uri(self.dataset.source_bucket, entry['key']) for entry in entries]
+        logger.info("Reading Raw data from {} files ({} bytes): {}".format(
+            str(len(entries)), str(sum(entry['size'] for entry in entries)), ", ".join(s3_paths[:3]) +
+            (", ..." if len(s3_paths) > 3 else "")))
+
+        source_count = self._stage_source(s3_paths[0] if len(s3_paths) == 1 else s3_paths)
+        if self.deduplicate:
+            self._load_seen_fingerprints()
+        # A single source keeps its key as source_file, several keep the URI of each row's file
+        # CREATE TABLE AS returns the number of rows it wrote
+        result = self.conn.execute(
+            BRONZE_CREATE_TABLE.format(**self._dedup_clauses(('bronze_seen_fingerprints', 'fingerprint'))),
+            {'source_file': entries[0]['key'] if len(entries) == 1 else None}
+        ).fetchone()
+        self.conn.execute("DROP TABLE bronze_staging")
+
+        self.record_count = result[0] if result else 0
+        self.duplicates_dropped = source_count - self.record_count
+        logger.info("Raw data ingestion completed. Total records ingested: {}, duplicates dropped: {}".format(
+            str(self.record_count), str(self.duplicates_dropped)),
+            extra={'records_ingested': self.record_count, 'duplicates_dropped': self.duplicates_dropped})
+        if not config.PRODUCTION_MODE:
+            logger.info("Sample records from the first 5 rows:\n" + str(self.conn.execute("SELECT * FROM bronze_heart_disease LIMIT 5").fetchdf()))
         return self.conn
     
-    def save_to_S3(self, local_path=None):
-        print("\n Preparing to export Bronze layer to S3")
+    def _ingest_nothing(self):
+        # Every source object is unchanged, Bronze gets no rows but keeps its schema
+        bronze = SnapshotTable("bronze_heart_disease", self.dataset.bronze_prefix, self.storage, self.dataset.target_bucket)
+        self.conn.execute(BRONZE_EMPTY_TABLE.format(files=_file_list(bronze.files())))
+        self.record_count = 0
+        self.duplicates_dropped = 0
+        logger.info("Raw data ingestion completed. No source object changed since the last run.",
+                    extra={'records_ingested': 0, 'duplicates_dropped': 0})
+        return self.conn
+
+    def ingest_batch(self, csv_paths):
+        self.init_connection()
+        source_count = self._stage_source(csv_paths)
+        self.conn.execute(BRONZE_BATCH_CREATE_TABLE)
+        if self.deduplicate and not self.index_loaded:
+            # The stored index covers earlier runs and streams, the Bronze table this stream's batches
+            self._load_seen_fingerprints()
+            self.index_loaded = True
+        result = self.conn.execute(BRONZE_APPEND_BATCH.format(**self._dedup_clauses(
+            ('bronze_seen_fingerprints', 'fingerprint'), ('bronze_heart_disease', 'row_fingerprint')))).fetchone()
+        self.conn.execute("DROP TABLE bronze_staging")
+        self.record_count = result[0] if result else 0
+        self.duplicates_dropped = source_count - self.record_count
+        logger.info("Micro-batch ingested {} records from {} files, {} duplicates dropped.".format(
+            str(self.record_count), str(len(csv_paths)), str(self.duplicates_dropped)),
+            extra={'records_ingested': self.record_count, 'duplicates_dropped': self.duplicates_dropped})
+        return self.record_count
+
+    def load_unabsorbed(self):
+        """Add the stored Bronze rows that never reached Silver to bronze_heart_disease.
+
+        Silver rows keep the ingestion_timestamp of their Bronze batch, so a batch with no Silver
+        row was not absorbed yet. A batch whose rows all failed validation looks the same and is
+        validated again, which adds nothing to Silver. Returns the number of rows added.
+        """
+        self.unabsorbed_count = 0
+        if not self.deduplicate:
+            # Without deduplication Bronze is replaced by every run, there is no backlog
+            return 0
+        bronze = SnapshotTable("bronze_heart_disease", self.dataset.bronze_prefix, self.storage, self.dataset.target_bucket)
+        if bronze.pointer() is None:
+            return 0
+        uris = bronze.files()
+        if not uris:
+            return 0
+        silver = SnapshotTable("silver_heart_disease", self.dataset.silver_prefix, self.storage, self.dataset.target_bucket)
+        silver_uris = silver.files() if silver.pointer() is not None else []
+        absorbed = BRONZE_ABSORBED_BATCHES.format(files=_file_list(silver_uris)) if silver_uris else ""
+
+        result = self.conn.execute(BRONZE_UNABSORBED_BATCHES.format(files=_file_list(uris), absorbed=absorbed)).fetchone()
+        if result and result[0]:
+            # Files holding only older batches are pruned by their min/max statistics
+            oldest = self.conn.execute(
+                "SELECT MIN(timezone('UTC', ingestion_timestamp)) FROM bronze_unabsorbed_batches").fetchone()[0]
+            uris = bronze.files(filters={'ingestion_timestamp': ('>=', oldest)})
+            result = self.conn.execute(BRONZE_LOAD_UNABSORBED.format(files=_file_list(uris))).fetchone()
+            self.unabsorbed_count = result[0] if result else 0
+        self.conn.execute("DROP TABLE bronze_unabsorbed_batches")
+        if self.unabsorbed_count:
+            logger.info("Loaded {} stored Bronze records that Silver has not absorbed yet.".format(str(self.unabsorbed_count)),
+                        extra={'unabsorbed_records': self.unabsorbed_count})
+        return self.unabsorbed_count
+
+    def save_to_S3(self, local_path=None, mode=None, where=None):
+        """Commit bronze_heart_disease as a snapshot; mode='append' with a `where` predicate adds only those rows.
+
+        With deduplication the table holds only rows no earlier run ingested, so they are
+        appended by default; otherwise the snapshot is replaced.
+        """
+        logger.info("Preparing to export Bronze layer to S3")
 
         if local_path is None:
-            local_path = os.path.join(tempfile.gettempdir(), "bronze_heart_disease.parquet")
-
-        self.conn.execute(
-            "COPY bronze_heart_disease TO ? (FORMAT PARQUET, COMPRESSION SNAPPY)",
-            [local_path]
-        )
-
-        S3_client = boto3.client(
-            's3',
-            aws_access_key_id=config.AWS_ACCESS_KEY_ID,
-            aws_secret_access_key=config.AWS_SECRET_ACCESS_KEY,
-            region_name=config.AWS_REGION
-            )
-        
-        S3_key = config.BRONZE_PREFIX + "bronze_layer_heart_data.parquet"
+            local_path = os.path.join(tempfile.gettempdir(), "bronze_heart_disease")
+        mode = mode or ('append' if self.deduplicate else 'overwrite')
+        where = "WHERE " + where if where else ""
+
+        table = SnapshotTable("bronze_heart_disease", self.dataset.bronze_prefix, self.storage, self.dataset.target_bucket)
         try:
-            S3_client.upload_file(local_path, config.TARGET_BUCKET, S3_key)
-            print("Bronze layer successfully exported to s3://{}/{}".format(config.TARGET_BUCKET, S3_key))
+            manifest = table.commit(self.conn, "SELECT * FROM bronze_heart_disease " + where, mode=mode, staging_dir=local_path)
+            logger.info("Bronze layer snapshot {} exported to {} ({} files, {} records)".format(
+                manifest['snapshot_id'], self.storage.uri(self.dataset.target_bucket, table.base_key),
+                str(len(manifest['files'])), str(manifest['row_count'])))
+            table.expire_snapshots()
         except Exception as e:
-            print("Error uploading Bronze layer to S3: {}".format(str(e)))
-            print("The Bronze layer data is saved locally at: {}".format(local_path))
+            logger.error("Error uploading Bronze layer to S3: {}".format(str(e)))
+            logger.error("The Bronze layer data is staged locally at: {}".format(local_path))
+            raise
 
-        if os.path.exists(local_path):
-            os.remove(local_path)
-            print("Local Bronze layer file removed after upload.")
+    def commit_fingerprints(self, local_path=None, where=None):
+        """Append the hashes of the exported rows to the index; call right after save_to_S3.
+
+        Rows exported to Bronze but lost by a later failure are picked up by load_unabsorbed.
+        """
+        if not self.deduplicate:
+            return None
+        if local_path is None:
+            local_path = os.path.join(tempfile.gettempdir(), "bronze_fingerprints")
+        where = "WHERE " + where if where else ""
+        fingerprints = self.fingerprints()
+        properties = None
+        if self.source_entries:
+            # Remember the ETags of the objects read, so plan_sources can skip them while unchanged
+            source_etags = dict(self._covered_sources())
+            source_etags.update((self.storage.uri(self.dataset.source_bucket, entry['key']), entry['etag'])
+                                for entry in self.source_entries if entry['etag'])
+            properties = {'source_etags': source_etags}
+        index = fingerprints.commit(self.conn, BRONZE_NEW_FINGERPRINTS.format(where=where), mode='append',
+                                    staging_dir=local_path, properties=properties)
+        logger.info("Row fingerprint index now holds {} hashes.".format(str(index['row_count'])))
+        fingerprints.expire_snapshots()
+        return index
     
     def get_connection(self):
         if self.conn is None:
@@ -107,26 +287,23 @@ class BronzeLayer:
     def close(self):
         if self.conn:
             self.conn.close()
-            print("DuckDB connection closed.")
+            logger.info("DuckDB connection closed.")
 
 def main():
 
     load_dotenv()
+    config.configure_logging()
     config.validate_config()
     config.print_config_summary()
 
     bronze = BronzeLayer()
     conn = bronze.raw_data_ingestion()
     bronze.save_to_S3()
+    bronze.commit_fingerprints()
+    ProfileLayer(conn).profile_layer('bronze', 'bronze_heart_disease')
 
-    print("\n Bronze Layer Stats:")
-    result = conn.execute("""
-            SELECT COUNT(*) AS Total_Records,
-            COUNT(DISTINCT id) AS Unique_Patients,
-            MIN(ingestion_timestamp) AS Ingestion_Time
-            FROM bronze_heart_disease
-            """).fetchdf()
-    print(result)
+    result = conn.execute(BRONZE_PROFILE_STATS).fetchdf()
+    logger.info("Bronze Layer Stats:\n" + str(result))
     bronze.close()
 
 if __name__ == "__main__":
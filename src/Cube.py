@@ -0,0 +1,103 @@
+# OLAP Cube -- answers group-by requests from gold_cube, falling back to Silver
+
+import os
+import sys
+import logging
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from sql.transformations import CUBE_DIMENSIONS, CUBE_MEASURES, SILVER_ONLY_MEASURES
+
+logger = logging.getLogger(__name__)
+
+DIMENSION_ALIASES = {'severity': 'heart_disease_severity'}
+
+
+class CubeQuery:
+    """Routes group-by requests to the precomputed gold_cube.
+
+    A request is answered from the cube when every group-by and filter column is a
+    cube dimension and every measure is additive; the matching grouping set is
+    selected by grouping_id and re-aggregated. Anything else, or every request when
+    cube_table is None or not built yet, is computed from silver_heart_disease.
+    """
+
+    def __init__(self, conn, cube_table='gold_cube', silver_table='silver_heart_disease'):
+        self.conn = conn
+        self.cube_table = cube_table
+        self.silver_table = silver_table
+        self.last_route = None
+
+    def _column(self, name):
+        name = DIMENSION_ALIASES.get(name, name)
+        if not name.replace('_', '').isalnum():
+            raise ValueError("Invalid column name: " + name)
+        return name
+
+    def _where(self, filters):
+        clauses = []
+        params = []
+        for column, value in filters.items():
+            if isinstance(value, (list, tuple, set)):
+                clauses.append(column + " IN (" + ", ".join("?" for _ in value) + ")")
+                params.extend(value)
+            elif value is None:
+                clauses.append(column + " IS NULL")
+            else:
+                clauses.append(column + " = ?")
+                params.append(value)
+        return clauses, params
+
+    def _grouping_id(self, grouped):
+        # GROUPING() sets a bit for every dimension that is rolled up, first dimension highest
+        grouping_id = 0
+        for i, dimension in enumerate(CUBE_DIMENSIONS):
+            if dimension not in grouped:
+                grouping_id |= 1 << (len(CUBE_DIMENSIONS) - 1 - i)
+        return grouping_id
+
+    def cube_available(self):
+        if self.cube_table is None:
+            return False
+        return self.conn.execute(
+            "SELECT COUNT(*) FROM information_schema.tables WHERE table_name = ? AND table_schema = current_schema()",
+            [self.cube_table]).fetchone()[0] > 0
+
+    def can_use_cube(self, group_by, filters, measures):
+        columns = set(group_by) | set(filters)
+        return (columns.issubset(CUBE_DIMENSIONS) and all(measure in CUBE_MEASURES for measure in measures)
+                and self.cube_available())
+
+    def query(self, group_by, measures=None, filters=None, order_by=None):
+        group_by = [self._column(column) for column in group_by]
+        filters = dict((self._column(column), value) for column, value in (filters or {}).items())
+        measures = list(measures or ['patient_count'])
+        for measure in measures:
+            if measure not in CUBE_MEASURES and measure not in SILVER_ONLY_MEASURES:
+                raise ValueError("Unknown measure: " + measure)
+
+        clauses, params = self._where(filters)
+        if self.can_use_cube(group_by, filters, measures):
+            self.last_route = 'cube'
+            source = self.cube_table
+            select = [CUBE_MEASURES[measure][0] + " AS " + measure for measure in measures]
+            clauses.insert(0, "grouping_id = ?")
+            params.insert(0, self._grouping_id(set(group_by) | set(filters)))
+        else:
+            self.last_route = 'silver'
+            source = self.silver_table
+            select = [(CUBE_MEASURES[measure][1] if measure in CUBE_MEASURES else SILVER_ONLY_MEASURES[measure])
+                      + " AS " + measure for measure in measures]
+
+        sql = "SELECT " + ", ".join(group_by + select) + " FROM " + source
+        if clauses:
+            sql += " WHERE " + " AND ".join(clauses)
+        if group_by:
+            sql += " GROUP BY " + ", ".join(group_by)
+            order_columns = [self._column(column) for column in (order_by or group_by)]
+            sql += " ORDER BY " + ", ".join(order_columns)
+        return self.conn.execute(sql, params).fetchdf()
+
+    def display_slice(self, group_by, measures=None, filters=None):
+        result = self.query(group_by, measures, filters)
+        logger.info(", ".join(measures or ['patient_count']) + " by " + ", ".join(group_by) +
+                    " (answered from " + self.last_route + ")\n" + str(result))
+        return result
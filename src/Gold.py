@@ -1,7 +1,7 @@
 #Gold Layer -- Final Curated data, ready for analysis and reporting
 
 import duckdb
-import boto3
+import logging
 import os
 import sys
 import tempfile
@@ -9,6 +9,10 @@ sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 import config
 from Bronze import BronzeLayer
 from Silver import SilverLayer
+from storage import get_storage
+from snapshot import SnapshotTable, cluster_order_by
+from Scoring import RiskScorer
+from Cube import CubeQuery
 from dotenv import load_dotenv
 from sql.transformations import (
     GOLD_DEMO_SUMMARY,
@@ -16,13 +20,24 @@ from sql.transformations import (
     GOLD_SEVERITY_DISTRIBUTION,
     GOLD_CLINICAL_METRICS,
     GOLD_POWERBI_FACT_TABLE,
-    GET_RECORD_COUNTS
+    GOLD_DIMENSIONS,
+    GOLD_DIMENSION_TABLE,
+    GOLD_DIMENSION_NO_PREVIOUS,
+    GOLD_DIMENSION_JOIN,
+    GOLD_CUBE,
+    GET_RECORD_COUNTS,
+    GOLD_SILVER_PARQUET_SOURCE
 )
 
+logger = logging.getLogger(__name__)
+
 class GoldLayer:
-    def __init__(self, conn):
+    def __init__(self, conn, storage=None, dataset=None):
         self.conn = conn
+        self.storage = storage or get_storage()
+        self.dataset = dataset or config.get_default_dataset()
         self.gold_tables = []
+        self.scorer = None
 
     def validate_table_name(self, table_name):
         if not table_name.replace('_', '') .isalnum():
@@ -31,113 +46,198 @@ class GoldLayer:
             raise ValueError("Table name is too long: " + table_name)
         return table_name
 
-    def create_aggregations(self):
-        print("\n Gold Layer: Final Curated Data for Analysis")
-        aggregations = [
+    def load_silver_from_parquet(self, parquet_path=None, snapshot_id=None, filters=None):
+        # Parquet footers are re-read by every Gold query otherwise
+        self.conn.execute("SET enable_object_cache = true")
+
+        parquet_path = parquet_path or config.SILVER_PARQUET_PATH
+        if parquet_path:
+            logger.info("Reading Silver layer from Parquet: " + parquet_path)
+            self.conn.execute(GOLD_SILVER_PARQUET_SOURCE.format(parquet_path=parquet_path.replace("'", "''")))
+        else:
+            table = SnapshotTable("silver_heart_disease", self.dataset.silver_prefix, self.storage, self.dataset.target_bucket)
+            files = table.attach(self.conn, snapshot_id=snapshot_id, filters=filters)
+            logger.info("Reading Silver layer snapshot " + (snapshot_id or "current") + " from " +
+                        str(len(files)) + " Parquet files")
+
+        if not config.PRODUCTION_MODE:
+            columns = self.conn.execute("DESCRIBE silver_heart_disease").fetchall()
+            logger.info("Silver Parquet attached with " + str(len(columns)) + " columns.")
+        return self.conn
+
+    def risk_scorer(self):
+        if self.scorer is None:
+            self.scorer = RiskScorer(self.conn)
+        return self.scorer
+
+    def _match(self, columns, left, right):
+        return " AND ".join("{0}.{2} IS NOT DISTINCT FROM {1}.{2}".format(left, right, column) for column in columns)
+
+    def _previous_dimension(self, dimension, key):
+        """Load the previous version of a dimension into <dimension>_previous, from this
+        database or else from its Gold snapshot, and return the SQL that reads it"""
+        previous_table = dimension + "_previous"
+        exists = self.conn.execute(
+            "SELECT COUNT(*) FROM information_schema.tables WHERE table_name = ? AND table_schema = current_schema()",
+            [dimension]).fetchone()[0]
+        if exists:
+            self.conn.execute("CREATE OR REPLACE TEMP TABLE {} AS SELECT * FROM {}".format(previous_table, dimension))
+            return "SELECT * FROM " + previous_table
+
+        table = SnapshotTable(dimension, self.dataset.gold_prefix, self.storage, self.dataset.target_bucket)
+        try:
+            if table.pointer() is not None:
+                table.attach(self.conn, dimension + "_snapshot")
+                self.conn.execute("CREATE OR REPLACE TEMP TABLE {} AS SELECT * FROM {}_snapshot".format(previous_table, dimension))
+                self.conn.execute("DROP VIEW {}_snapshot".format(dimension))
+                return "SELECT * FROM " + previous_table
+        except ValueError:
+            pass
+        return GOLD_DIMENSION_NO_PREVIOUS.format(key=key)
+
+    def build_dimensions(self):
+        for dimension, key, columns, derived in GOLD_DIMENSIONS:
+            self.validate_table_name(dimension)
+            previous = self._previous_dimension(dimension, key)
+            result = self.conn.execute(GOLD_DIMENSION_TABLE.format(
+                dimension=dimension,
+                key=key,
+                columns=", ".join(columns),
+                derived="".join(",\n        {} AS {}".format(expression, name) for name, expression in derived.items()),
+                previous=previous,
+                match=self._match(columns, 'm', 'p')
+            )).fetchone()
+            self.conn.execute("DROP TABLE IF EXISTS {}_previous".format(dimension))
+            if dimension not in self.gold_tables:
+                self.gold_tables.append(dimension)
+            logger.info("Created Dimension: " + dimension + " with " + str(result[0] if result else 0) + " members.")
+
+    def star_tables(self):
+        return ['gold_powerbi_fact_table'] + [dimension for dimension, _, _, _ in GOLD_DIMENSIONS]
+
+    def aggregations(self):
+        fact_table_sql = GOLD_POWERBI_FACT_TABLE.format(
+            risk_score=self.risk_scorer().expression(),
+            dimension_keys=",\n    ".join(dimension + "." + key for dimension, key, _, _ in GOLD_DIMENSIONS),
+            dimension_joins="\n".join(GOLD_DIMENSION_JOIN.format(dimension=dimension, match=self._match(columns, 's', dimension))
+                                      for dimension, _, columns, _ in GOLD_DIMENSIONS),
+            order_by=cluster_order_by('gold_powerbi_fact_table')
+        )
+        return [
             ("Demographics Summary", GOLD_DEMO_SUMMARY),
             ("Risk Factor Analysis", GOLD_RISK_FACTORS),
             ("Severity Distribution in Patients", GOLD_SEVERITY_DISTRIBUTION),
             ("Clinical Metrics", GOLD_CLINICAL_METRICS),
-            ("PowerBI Fact Table", GOLD_POWERBI_FACT_TABLE)
+            ("PowerBI Fact Table", fact_table_sql),
+            ("OLAP Cube", GOLD_CUBE)
         ]
 
-        for name, sql in aggregations:
-            print("\n Processing aggregations " + name)
-            self.conn.execute(sql)
-            table_name = sql.split("CREATE TABLE IF NOT EXISTS ")[1].split("AS")[0].strip()
-            self.gold_tables.append(table_name)
-            validated_name = self.validate_table_name(table_name)
-            count = self.conn.execute("SELECT COUNT(*) FROM {}".format(validated_name)).fetchone()[0]
-            print("\n Created Table: " + validated_name + " with " + str(count) + " records.")
+    def table_name_of(self, sql):
+        table_name = sql.split("CREATE TABLE IF NOT EXISTS ")[1].split("AS")[0].strip()
+        return self.validate_table_name(table_name)
+
+    def create_aggregations(self):
+        logger.info("Gold Layer: Final Curated Data for Analysis")
+        # The fact table is keyed on the dimensions, they are built first
+        self.build_dimensions()
+
+        for name, sql in self.aggregations():
+            logger.debug("Processing aggregations " + name)
+            # CREATE TABLE AS returns the number of rows it wrote
+            result = self.conn.execute(sql).fetchone()
+            validated_name = self.table_name_of(sql)
+            if validated_name not in self.gold_tables:
+                self.gold_tables.append(validated_name)
+            count = result[0] if result else 0
+            logger.info("Created Table: " + validated_name + " with " + str(count) + " records.",
+                        extra={'table': validated_name, 'records': count})
+
+    def refresh_aggregations(self):
+        # Gold tables are rebuilt from the full Silver table; they are small aggregates,
+        # and averages and medians cannot be merged from the previous batch's results.
+        for _, sql in self.aggregations():
+            self.conn.execute("DROP TABLE IF EXISTS {}".format(self.table_name_of(sql)))
+        self.create_aggregations()
 
     def display_demo(self):
-        print("\n Demographics Summary Sample:")
-        print(self.conn.execute("""
-                          SELECT sex,
-                                 age_group,
-                                patient_count,
-                                heart_disease_percentage,
-                                ROUND(avg_cholesterol, 1) AS avg_cholesterol,
-                                ROUND(avg_blood_pressure, 1) AS avg_bp, 
-                          FROM gold_demographics_summary
-                          ORDER BY sex, age_group 
-                          LIMIT 10
-                          """).fetchdf())
+        cube = CubeQuery(self.conn)
+        demographics = cube.query(['sex', 'age_group'],
+                                  ['patient_count', 'heart_disease_percentage', 'avg_cholesterol', 'avg_blood_pressure'])
+        demographics = demographics.round({'avg_cholesterol': 1, 'avg_blood_pressure': 1}).rename(
+            columns={'avg_blood_pressure': 'avg_bp'})
+        logger.info("Demographics Summary Sample (answered from " + cube.last_route + "):\n" + str(demographics.head(10)))
         
     def display_top_risk(self):
-        print("\n Displaying Top Risk factors: ")
-        print(self.conn.execute("""
+        logger.info("Top Risk factors:\n" + str(self.conn.execute("""
                           SELECT chest_pain_type, exercise_induced_angina, patient_count, heart_disease_count, risk_percentage
                           FROM gold_risk_factors
                           WHERE patient_count >= 10
                           ORDER BY risk_percentage DESC
                           LIMIT 10
-                          """).fetchdf())
+                          """).fetchdf()))
     
     def display_severity_distribution(self):
-        print("\n Displaying Severity Distribution among patients: ")
-        print(self.conn.execute("""
-                          SELECT severity_label, patient_count, percentage, ROUND(avg_age, 1) AS avg_age
-                          FROM gold_severity_distribution
-                          ORDER BY heart_disease_severity
-                          """).fetchdf())
+        cube = CubeQuery(self.conn)
+        severity = cube.query(['severity'], ['patient_count', 'avg_age'])
+        labels = self.conn.execute("SELECT DISTINCT heart_disease_severity, severity_label FROM gold_dim_severity").fetchdf()
+        severity = severity.merge(labels, on='heart_disease_severity', how='left')
+        severity['percentage'] = (severity['patient_count'] * 100.0 / severity['patient_count'].sum()).round(2)
+        severity['avg_age'] = severity['avg_age'].round(1)
+        logger.info("Severity Distribution among patients (answered from " + cube.last_route + "):\n" +
+                    str(severity[['severity_label', 'patient_count', 'percentage', 'avg_age']]))
 
     def display_all_records(self):
-        print("\n Displaying all records")
         counts = self.conn.execute(GET_RECORD_COUNTS).fetchdf()
-        print(counts)
+        logger.info("Record counts of all layers:\n" + str(counts))
 
     def save_to_S3(self):
-        print("\n Saving Gold Layer tables locally and uploading to S3 as Parquet")
-
-        S3_client = boto3.client(
-            's3',
-            aws_access_key_id=config.AWS_ACCESS_KEY_ID,
-            aws_secret_access_key=config.AWS_SECRET_ACCESS_KEY,
-            region_name=config.AWS_REGION
-        )
+        logger.info("Saving Gold Layer tables locally and uploading to S3 as Parquet")
 
         for table_name in self.gold_tables:
             validated_name = self.validate_table_name(table_name)
-            local_path = os.path.join(tempfile.gettempdir(), validated_name + ".parquet")
-            self.conn.execute("COPY {} TO ? (FORMAT PARQUET, COMPRESSION SNAPPY)".format(validated_name), [local_path])
-            S3_key = config.GOLD_PREFIX + validated_name + ".parquet"
+            local_path = os.path.join(tempfile.gettempdir(), validated_name)
+            table = SnapshotTable(validated_name, self.dataset.gold_prefix, self.storage, self.dataset.target_bucket)
 
             try:
-                S3_client.upload_file(local_path, config.TARGET_BUCKET, S3_key)
-                print("Successfully uploaded " + validated_name + " to s3://" + config.TARGET_BUCKET + "/" + S3_key)
+                manifest = table.commit(self.conn, "SELECT * FROM " + validated_name + " " + cluster_order_by(validated_name),
+                                        staging_dir=local_path)
+                logger.info("Successfully uploaded " + validated_name + " snapshot " + manifest['snapshot_id'] + " to " +
+                            self.storage.uri(self.dataset.target_bucket, table.base_key))
+                table.expire_snapshots()
             except Exception as e:
-                print("Error uploading " + validated_name + " to S3: " + str(e))
-                print("The Gold layer table " + validated_name + " is saved locally at: " + local_path)
-
-            if os.path.exists(local_path):
-                os.remove(local_path)
-                print("Local file for " + validated_name + " removed after upload.")
+                logger.error("Error uploading " + validated_name + " to S3: " + str(e))
+                logger.error("The Gold layer table " + validated_name + " is staged locally at: " + local_path)
+                raise
                 
     def for_powerbi(self, output_path=None):
-        print("\n Preparing curated data for PowerBI visualization")
+        logger.info("Preparing curated data for PowerBI visualization")
 
         if output_path is None:
-            output_path = os.path.join(tempfile.gettempdir(), "powerbi_fact_table")
+            folder = "powerbi_fact_table" if self.dataset.name == 'default' else "powerbi_fact_table_" + self.dataset.name
+            output_path = os.path.join(tempfile.gettempdir(), folder)
         
         os.makedirs(output_path, exist_ok=True)
-        for table_name in self.gold_tables:
+        for table_name in self.star_tables():
             validated_name = self.validate_table_name(table_name)
             csv_path = os.path.join(output_path, validated_name + ".csv")
-        
-        self.conn.execute("COPY {} TO ? (HEADER, DELIMITER ',')".format(validated_name), [csv_path])
-        print("PowerBI fact table saved locally at: " + csv_path)
+            self.conn.execute("COPY {} TO ? (HEADER, DELIMITER ',')".format(validated_name), [csv_path])
+        logger.info("PowerBI star schema (fact table and " + str(len(GOLD_DIMENSIONS)) + " dimensions) saved locally at: " + output_path)
         return output_path
 
 def main():
     load_dotenv()
+    config.configure_logging()
     config.validate_config()
-    bronze = BronzeLayer()
+    storage = get_storage()
+    bronze = BronzeLayer(storage)
     conn = bronze.raw_data_ingestion()
-    silver = SilverLayer(conn)
+    bronze.load_unabsorbed()
+    silver = SilverLayer(conn, storage)
     silver.data_cleaning_and_standardization()
+    if bronze.deduplicate:
+        silver.merge_previous_snapshot()
 
-    gold = GoldLayer(conn)
+    gold = GoldLayer(conn, storage)
     gold.create_aggregations()
     gold.display_demo()
     gold.display_top_risk()
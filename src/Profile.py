@@ -0,0 +1,98 @@
+# Profiling Stage -- Single-pass column statistics for each layer
+
+import os
+import sys
+import logging
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import config
+from sql.transformations import (
+    PROFILE_CREATE_TABLE,
+    PROFILE_COLUMN_STATS,
+    PROFILE_QUANTILES,
+    PROFILE_VALUE_COUNTS,
+    PROFILE_NO_QUANTILES,
+    PROFILE_NO_VALUE_COUNTS,
+    PROFILE_VALUE_DISTRIBUTION,
+    PROFILE_ROW_CHECK,
+    BRONZE_CRITICAL_NULL_ROWS
+)
+
+logger = logging.getLogger(__name__)
+
+NUMERIC_TYPES = ('TINYINT', 'SMALLINT', 'INTEGER', 'BIGINT', 'HUGEINT', 'UTINYINT', 'USMALLINT',
+                 'UINTEGER', 'UBIGINT', 'FLOAT', 'DOUBLE', 'DECIMAL')
+CATEGORICAL_TYPES = ('VARCHAR', 'BOOLEAN')
+# Row-level counts stored with a layer's profile, by column name
+ROW_CHECKS = {
+    'bronze': {'critical_null_rows': BRONZE_CRITICAL_NULL_ROWS}
+}
+
+
+class ProfileLayer:
+    """Single-pass column statistics stored in a <layer>_profile table"""
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.profile_tables = []
+
+    def validate_name(self, name):
+        if not name.replace('_', '').isalnum():
+            raise ValueError("Invalid table name: " + name)
+        return name
+
+    def _column_stats_sql(self, column_name, column_type):
+        column = '"' + column_name.replace('"', '""') + '"'
+        base_type = column_type.split('(')[0].upper()
+
+        if base_type in NUMERIC_TYPES:
+            step = 1.0 / config.PROFILE_HISTOGRAM_BUCKETS
+            fractions = [round(step * i, 6) for i in range(1, config.PROFILE_HISTOGRAM_BUCKETS)]
+            quantiles = PROFILE_QUANTILES.format(column=column, fractions=str(fractions))
+        else:
+            quantiles = PROFILE_NO_QUANTILES
+
+        if base_type in CATEGORICAL_TYPES:
+            value_counts = PROFILE_VALUE_COUNTS.format(column=column)
+        else:
+            value_counts = PROFILE_NO_VALUE_COUNTS
+
+        return PROFILE_COLUMN_STATS.format(
+            column_name=column_name.replace("'", "''"),
+            column_type=column_type.replace("'", "''"),
+            column=column,
+            quantiles=quantiles,
+            value_counts=value_counts,
+            top_k=int(config.PROFILE_TOP_K)
+        )
+
+    def profile_layer(self, layer, source_table):
+        layer = self.validate_name(layer)
+        source_table = self.validate_name(source_table)
+        profile_table = layer + "_profile"
+
+        logger.info("Profiling " + source_table + " into " + profile_table)
+        columns = self.conn.execute("DESCRIBE " + source_table).fetchall()
+        column_stats = ",".join(self._column_stats_sql(column[0], column[1]) for column in columns)
+        row_checks = sorted(ROW_CHECKS.get(layer, {}).items())
+
+        self.conn.execute(PROFILE_CREATE_TABLE.format(
+            profile_table=profile_table,
+            layer=layer,
+            column_stats=column_stats,
+            row_check_columns="".join("\n    " + name + "," for name, _ in row_checks),
+            row_checks="".join(",\n    " + PROFILE_ROW_CHECK.format(predicate=predicate, name=name)
+                               for name, predicate in row_checks),
+            source_table=source_table
+        ))
+        if profile_table not in self.profile_tables:
+            self.profile_tables.append(profile_table)
+        logger.info("Profiled " + str(len(columns)) + " columns of " + source_table + ".")
+        return profile_table
+
+    def get_profile(self, layer):
+        profile_table = self.validate_name(layer) + "_profile"
+        return self.conn.execute("SELECT * FROM {} ORDER BY column_name".format(profile_table)).fetchdf()
+
+    def get_value_distribution(self, layer, column_name):
+        profile_table = self.validate_name(layer) + "_profile"
+        return self.conn.execute(PROFILE_VALUE_DISTRIBUTION.format(profile_table=profile_table), [column_name]).fetchdf()
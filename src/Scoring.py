@@ -0,0 +1,159 @@
+# Risk Scoring Stage -- configurable, vectorized calculated_risk_score for the Gold fact table
+
+import os
+import sys
+import importlib
+import uuid
+import numpy as np
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import config
+
+OPERATORS = {
+    '=': np.equal,
+    '!=': np.not_equal,
+    '>': np.greater,
+    '>=': np.greater_equal,
+    '<': np.less,
+    '<=': np.less_equal
+}
+
+
+def _sql_literal(value):
+    if isinstance(value, bool):
+        return 'TRUE' if value else 'FALSE'
+    if isinstance(value, (int, float)):
+        return repr(value)
+    return "'" + str(value).replace("'", "''") + "'"
+
+
+class WeightedRiskModel:
+    """Sum of weights of the rules that hold, each rule being (column, operator, threshold, weight).
+
+    Usable both as a SQL expression and as a NumPy scorer over column batches; a NULL
+    input never satisfies a rule, as in SQL. The score is an INTEGER when every weight
+    is an int and a DOUBLE otherwise.
+    """
+
+    def __init__(self, rules=None):
+        self.rules = rules if rules is not None else config.get_risk_score_rules()
+        for column, operator, _, _ in self.rules:
+            if operator not in OPERATORS:
+                raise ValueError("Unsupported risk rule operator: " + operator)
+            if not column.replace('_', '').isalnum():
+                raise ValueError("Invalid risk rule column: " + column)
+        self.columns = sorted(set(rule[0] for rule in self.rules))
+        self.integer_weights = all(isinstance(rule[3], int) for rule in self.rules)
+
+    def sql_expression(self):
+        terms = ["CASE WHEN {} {} {} THEN {} ELSE 0 END".format(column, operator, _sql_literal(threshold), _sql_literal(weight))
+                 for column, operator, threshold, weight in self.rules]
+        expression = "(" + " +\n    ".join(terms or ['0']) + ")"
+        # Fractional weights would otherwise sum as DECIMAL
+        return expression if self.integer_weights else "CAST(" + expression + " AS DOUBLE)"
+
+    def __call__(self, columns, valid=None):
+        """Score a dict of column arrays; `valid` optionally maps columns to boolean masks of
+        non-NULL rows, without it NaN and None are taken as NULL"""
+        size = len(next(iter(columns.values()))) if columns else 0
+        score = np.zeros(size, dtype=np.int32 if self.integer_weights else np.float64)
+        for column, operator, threshold, weight in self.rules:
+            values = columns[column]
+            present = valid.get(column) if valid else None
+            if present is None:
+                if values.dtype == object:
+                    present = np.not_equal(values, None)
+                elif values.dtype.kind == 'f':
+                    present = ~np.isnan(values)
+            if values.dtype == object:
+                matched = np.zeros(len(values), dtype=bool)
+                matched[present] = OPERATORS[operator](values[present], threshold)
+            else:
+                with np.errstate(invalid='ignore'):
+                    matched = OPERATORS[operator](values, threshold)
+                if present is not None:
+                    matched &= present
+            score += np.where(matched, weight, 0).astype(score.dtype)
+        return score
+
+
+def load_scorer(spec):
+    """Load a user scorer from "module:function".
+
+    The function takes a dict of NumPy arrays (one per column, NaN or None for NULL) and
+    returns an array of scores; its `columns` attribute lists the input columns.
+    """
+    module_name, _, function_name = spec.partition(':')
+    scorer = getattr(importlib.import_module(module_name), function_name)
+    if not getattr(scorer, 'columns', None):
+        raise ValueError("Risk scorer " + spec + " must define a `columns` attribute.")
+    return scorer
+
+
+class RiskScorer:
+    """Provides the calculated_risk_score expression for the Gold fact table.
+
+    Weighted rules compile to a plain SQL expression. Python scorers are registered as
+    a DuckDB Arrow UDF, so they are called once per vector of rows with NumPy arrays,
+    never once per row.
+    """
+
+    def __init__(self, conn, model=None, force_udf=False):
+        self.conn = conn
+        # Functions are registered database-wide, keep names apart for connections sharing one
+        self.udf_name = 'risk_score_udf_' + uuid.uuid4().hex[:8]
+        if model is None:
+            model = load_scorer(config.RISK_SCORER) if config.RISK_SCORER else WeightedRiskModel()
+        self.model = model
+        self.force_udf = force_udf
+        self.registered = False
+
+    def _to_numpy(self, array):
+        import pyarrow as pa
+        if pa.types.is_boolean(array.type):
+            # The value under a NULL is arbitrary, the validity mask hides it
+            return array.fill_null(False).to_numpy(zero_copy_only=False)
+        if pa.types.is_integer(array.type) or pa.types.is_floating(array.type) or pa.types.is_decimal(array.type):
+            return array.cast(pa.float64()).fill_null(np.nan).to_numpy(zero_copy_only=False)
+        return array.to_numpy(zero_copy_only=False)
+
+    def _validity(self, array):
+        return array.is_valid().to_numpy(zero_copy_only=False) if array.null_count else np.ones(len(array), dtype=bool)
+
+    def _register_udf(self, source_table):
+        if self.registered:
+            return
+        import pyarrow as pa
+        column_types = dict((row[0], row[1]) for row in self.conn.execute("DESCRIBE " + source_table).fetchall())
+        missing = [column for column in self.model.columns if column not in column_types]
+        if missing:
+            raise ValueError("Risk scorer columns not found in " + source_table + ": " + ", ".join(missing))
+
+        model = self.model
+        columns = list(model.columns)
+        to_numpy = self._to_numpy
+        validity = self._validity
+        # Weighted rules return the same type as their SQL expression
+        weighted = isinstance(model, WeightedRiskModel)
+        integer_scores = weighted and model.integer_weights
+
+        # DuckDB binds one parameter per argument of the Python function, so the columns
+        # travel as a single struct and are unpacked by name
+        def score_batch(rows):
+            rows = rows.combine_chunks() if isinstance(rows, pa.ChunkedArray) else rows
+            batch = dict((column, to_numpy(rows.field(column))) for column in columns)
+            if weighted:
+                scores = model(batch, valid=dict((column, validity(rows.field(column))) for column in columns))
+            else:
+                scores = model(batch)
+            return pa.array(np.asarray(scores, dtype=np.int32 if integer_scores else np.float64))
+
+        row_type = self.conn.struct_type(dict((column, self.conn.sqltype(column_types[column])) for column in columns))
+        self.conn.create_function(self.udf_name, score_batch, [row_type], 'INTEGER' if integer_scores else 'DOUBLE',
+                                  type='arrow', null_handling='special')
+        self.registered = True
+
+    def expression(self, source_table='silver_heart_disease'):
+        if hasattr(self.model, 'sql_expression') and not self.force_udf:
+            return self.model.sql_expression()
+        self._register_udf(source_table)
+        return self.udf_name + "(struct_pack(" + ", ".join(column + " := " + column for column in self.model.columns) + "))"
@@ -1,20 +1,31 @@
 # Silver Layer -- Data Cleaning and Standardization
 
 import duckdb
-import boto3
+import logging
 from dotenv import load_dotenv
 from Bronze import BronzeLayer
+from Profile import ProfileLayer
+from Cube import CubeQuery
+from storage import get_storage
+from snapshot import SnapshotTable, cluster_order_by
 import os
 import sys
 import tempfile
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 import config
-from sql.transformations import ( SILVER_STAGE1_CAST_TYPES, SILVER_STAGE2_STANDARDIZATION, SILVER_STAGE3_QUALITY_CHECK, SILVER_FINAL_TABLE, DATA_QUALITY_REPORT)
+from sql.transformations import ( SILVER_STAGE1_CAST_TYPES, SILVER_STAGE2_STANDARDIZATION, SILVER_STAGE3_QUALITY_CHECK, SILVER_FINAL_TABLE, SILVER_MERGE_PREVIOUS,
+                                  SILVER_LOAD_SNAPSHOT, SILVER_NEW_ROWS, SILVER_APPEND_BATCH, DATA_QUALITY_REPORT)
+
+logger = logging.getLogger(__name__)
 
 class SilverLayer:
 
-    def __init__(self, conn):
+    def __init__(self, conn, storage=None, dataset=None):
         self.conn = conn
+        self.storage = storage or get_storage()
+        self.dataset = dataset or config.get_default_dataset()
+        self.record_count = None
+        self.incremental = False
 
     def _quality_rules_validation(self):
         rules = [
@@ -39,112 +50,173 @@ class SilverLayer:
                 raise ValueError("Data quality rule" + name + "is out of reasonable range.")
         return True
     
+    def _quality_check_sql(self):
+        self._quality_rules_validation()
+        quality_sql = SILVER_STAGE3_QUALITY_CHECK
+        for key, value in config.get_quality_rules().items():
+            quality_sql = quality_sql.replace('$' + key, str(value))
+        return quality_sql
+
     def data_cleaning_and_standardization(self):
-        print("\n Starting Silver Layer transformations: Data Cleaning and Standardization")
-        print("\n Stage 1: Type Casting")
+        logger.info("Starting Silver Layer transformations: Data Cleaning and Standardization")
+        logger.info("Stage 1: Type Casting")
         self.conn.execute(SILVER_STAGE1_CAST_TYPES)
-        stage1_count = self.conn.execute("SELECT COUNT(*) FROM silver_stage1_typed").fetchone()[0]
-        print("\n Stage 1 completed. Records in silver_stage1_typed: " + str(stage1_count))
+        if not config.PRODUCTION_MODE:
+            stage1_count = self.conn.execute("SELECT COUNT(*) FROM silver_stage1_typed").fetchone()[0]
+            logger.info("Stage 1 completed. Records in silver_stage1_typed: " + str(stage1_count))
 
-        print("\n Stage 2: Standardization")
+        logger.info("Stage 2: Standardization")
         self.conn.execute(SILVER_STAGE2_STANDARDIZATION)
-        stage2_count = self.conn.execute("SELECT COUNT(*) FROM silver_stage2_standardized").fetchone()[0]
-        print("\n Stage 2 completed. Records in silver_stage2_standardized: " + str(stage2_count))
-
-        print("\n Sample records after Standardization:")
-        sample = self.conn.execute("""
-                                   SELECT sex, chest_pain_type, resting_ecg, thalassemia,has_heart_disease
-                                   FROM silver_stage2_standardized LIMIT 5
-                                   """).fetchdf()
-        
-        print(sample)
-
-        print("\n Stage 3: Data Quality Checks")
-        self._quality_rules_validation()
-        quality_rules = config.get_quality_rules()
-        quality_sql = SILVER_STAGE3_QUALITY_CHECK
-        for key, value in quality_rules.items():
-            quality_sql = quality_sql.replace('$' + key, str(value))
-        self.conn.execute(quality_sql)
-
-        quality_stats = self.conn.execute("""
-            SELECT
-                COUNT(*) AS total_records,
-                SUM(CASE WHEN has_quality_issues THEN 1 ELSE 0 END) AS records_with_issues,
-                COUNT(*) - SUM(CASE WHEN has_quality_issues THEN 1 ELSE 0 END) AS clean_records
-            FROM silver_stage3_validated
-        """).fetchone()
-
-        print("\n Stage 3 completed. Data Quality Summary:")
-        print("Total Records: " + str(quality_stats[0]))
-        print("Records with Quality Issues: " + str(quality_stats[1]))  
-        print("Clean Records: " + str(quality_stats[2]))    
-
-        print("\n Creating final silver_heart_disease table with clean records only")
-        self.conn.execute(SILVER_FINAL_TABLE)
-        silver_count = self.conn.execute("SELECT COUNT(*) FROM silver_heart_disease").fetchone()[0]
-        print("\n Silver Layer processing completed. Records in silver_heart_disease: " + str(silver_count))
+        if not config.PRODUCTION_MODE:
+            stage2_count = self.conn.execute("SELECT COUNT(*) FROM silver_stage2_standardized").fetchone()[0]
+            logger.info("Stage 2 completed. Records in silver_stage2_standardized: " + str(stage2_count))
+
+            sample = self.conn.execute("""
+                                       SELECT sex, chest_pain_type, resting_ecg, thalassemia,has_heart_disease
+                                       FROM silver_stage2_standardized LIMIT 5
+                                       """).fetchdf()
+            logger.info("Sample records after Standardization:\n" + str(sample))
+
+        logger.info("Stage 3: Data Quality Checks")
+        self.conn.execute(self._quality_check_sql())
+
+        if not config.PRODUCTION_MODE:
+            quality_stats = self.conn.execute("""
+                SELECT
+                    COUNT(*) AS total_records,
+                    SUM(CASE WHEN has_quality_issues THEN 1 ELSE 0 END) AS records_with_issues,
+                    COUNT(*) - SUM(CASE WHEN has_quality_issues THEN 1 ELSE 0 END) AS clean_records
+                FROM silver_stage3_validated
+            """).fetchone()
+
+            logger.info("Stage 3 completed. Data Quality Summary: Total Records: {}, Records with Quality Issues: {}, Clean Records: {}".format(
+                str(quality_stats[0]), str(quality_stats[1]), str(quality_stats[2])))
+
+        logger.info("Creating final silver_heart_disease table with clean records only")
+        # CREATE TABLE AS returns the number of rows it wrote
+        result = self.conn.execute(SILVER_FINAL_TABLE.format(order_by=cluster_order_by('silver_heart_disease'))).fetchone()
+        self.record_count = result[0] if result else 0
+        logger.info("Silver Layer processing completed. Records in silver_heart_disease: " + str(self.record_count),
+                    extra={'silver_records': self.record_count})
 
         return self.conn
     
+    def merge_previous_snapshot(self):
+        """Merge the current Silver snapshot into silver_heart_disease, for runs that only ingested new rows.
+
+        Afterwards save_to_S3 appends just this run's rows. Returns the number of rows in the table.
+        """
+        table = SnapshotTable("silver_heart_disease", self.dataset.silver_prefix, self.storage, self.dataset.target_bucket)
+        if table.pointer() is None:
+            return self.record_count
+        uris = table.files()
+        total = self.record_count
+        if uris:
+            file_list = ", ".join("'" + uri.replace("'", "''") + "'" for uri in uris)
+            # CREATE TABLE AS returns the number of rows it wrote
+            result = self.conn.execute(SILVER_MERGE_PREVIOUS.format(
+                files=file_list, order_by=cluster_order_by('silver_heart_disease'))).fetchone()
+            total = result[0] if result else 0
+        self.incremental = True
+        logger.info("Merged the previous Silver snapshot: {} new and {} total records in silver_heart_disease.".format(
+            str(self.record_count), str(total)))
+        return total
+
+    def load_snapshot(self):
+        """Replace silver_heart_disease with the current Silver snapshot. Returns its row count, or None without one."""
+        table = SnapshotTable("silver_heart_disease", self.dataset.silver_prefix, self.storage, self.dataset.target_bucket)
+        pointer = table.pointer()
+        if pointer is None:
+            return None
+        uris = table.files(pointer['snapshot_id'])
+        if not uris:
+            return None
+        file_list = ", ".join("'" + uri.replace("'", "''") + "'" for uri in uris)
+        result = self.conn.execute(SILVER_LOAD_SNAPSHOT.format(files=file_list)).fetchone()
+        self.record_count = result[0] if result else 0
+        logger.info("Loaded {} records of Silver snapshot {}.".format(str(self.record_count), pointer['snapshot_id']))
+        return self.record_count
+
+    def process_batch(self, source_files):
+        tables = set(row[0] for row in self.conn.execute(
+            "SELECT table_name FROM information_schema.tables "
+            "WHERE table_name IN ('silver_heart_disease', 'silver_stage3_validated')").fetchall())
+        if 'silver_heart_disease' not in tables:
+            self.data_cleaning_and_standardization()
+            return self.record_count
+        if 'silver_stage3_validated' not in tables:
+            # The table came from load_snapshot, the stage views are still missing
+            self.conn.execute(SILVER_STAGE1_CAST_TYPES)
+            self.conn.execute(SILVER_STAGE2_STANDARDIZATION)
+            self.conn.execute(self._quality_check_sql())
+
+        result = self.conn.execute(SILVER_APPEND_BATCH, {'source_files': source_files}).fetchone()
+        silver_count = result[0] if result else 0
+        logger.info("Micro-batch appended {} clean records to silver_heart_disease.".format(str(silver_count)))
+        return silver_count
+
     def display_quality_report(self):
-        print("\n Data Quality Report")
         report = self.conn.execute(DATA_QUALITY_REPORT).fetchdf()
-        print(report)
+        logger.info("Data Quality Report\n" + str(report))
 
     def display_age_group_distribution(self):
-        print("\n Age Group Distribution")
-        age_distribution = self.conn.execute("""
-            SELECT 
-                age_group,
-                COUNT(*) AS count
-            FROM silver_heart_disease
-            GROUP BY age_group
-            ORDER BY age_group
-        """).fetchdf()
-        print(age_distribution)
-
-    def save_to_S3(self, local_path=None):
-        print("\n Preparing to export Silver layer to S3")
+        # Runs before Gold builds the cube, a gold_cube still in the database belongs to an earlier run
+        age_distribution = CubeQuery(self.conn, cube_table=None).query(['age_group'])
+        logger.info("Age Group Distribution\n" + str(age_distribution))
 
-        if local_path is None:
-            local_path = os.path.join(tempfile.gettempdir(), "silver_heart_disease.parquet")
+    def save_to_S3(self, local_path=None, mode=None, where=None):
+        """Commit silver_heart_disease as a snapshot; mode='append' with a `where` predicate adds only those rows.
 
-        self.conn.execute(
-            "COPY silver_heart_disease TO ? (FORMAT PARQUET, COMPRESSION SNAPPY)", [local_path])
+        After merge_previous_snapshot only this run's rows are appended by default.
+        """
+        logger.info("Preparing to export Silver layer to S3")
 
-        S3_client = boto3.client(
-            's3',
-            aws_access_key_id=config.AWS_ACCESS_KEY_ID,
-            aws_secret_access_key=config.AWS_SECRET_ACCESS_KEY,
-            region_name=config.AWS_REGION
-        )
-        S3_key = config.SILVER_PREFIX + "silver_layer_heart_data.parquet"
+        if local_path is None:
+            local_path = os.path.join(tempfile.gettempdir(), "silver_heart_disease")
+        if mode is None:
+            mode, where = ('append', where or SILVER_NEW_ROWS) if self.incremental else ('overwrite', where)
+        where = "WHERE " + where if where else ""
 
+        table = SnapshotTable("silver_heart_disease", self.dataset.silver_prefix, self.storage, self.dataset.target_bucket)
         try:
-            S3_client.upload_file(local_path, config.TARGET_BUCKET, S3_key)
-            print("Silver layer successfully exported to S3 at: s3://{}/{}".format(config.TARGET_BUCKET, S3_key))
+            manifest = table.commit(self.conn, "SELECT * FROM silver_heart_disease " + where + " " +
+                                    cluster_order_by('silver_heart_disease'), mode=mode, staging_dir=local_path)
+            logger.info("Silver layer snapshot {} exported to: {} ({} files, {} records)".format(
+                manifest['snapshot_id'], self.storage.uri(self.dataset.target_bucket, table.base_key),
+                str(len(manifest['files'])), str(manifest['row_count'])))
+            for key in ([] if config.PRODUCTION_MODE else config.SILVER_CLUSTER_KEYS):
+                row_groups, fraction = table.row_group_selectivity(self.conn, key, manifest['snapshot_id'])
+                logger.info("  - {}: an equality filter reads {:.1%} of {} row groups".format(key, fraction, str(row_groups)))
+            table.expire_snapshots()
         except Exception as e:
-            print("Error uploading Silver layer to S3: {}".format(str(e)))
-            print("Silver Layer data saved locally at: {}".format(local_path))
-
-        if os.path.exists(local_path):
-            os.remove(local_path)
+            logger.error("Error uploading Silver layer to S3: {}".format(str(e)))
+            logger.error("Silver Layer data staged locally at: {}".format(local_path))
+            raise
 
 def main():
     load_dotenv()
+    config.configure_logging()
     config.validate_config()
 
-    bronze = BronzeLayer()
+    storage = get_storage()
+    bronze = BronzeLayer(storage)
     conn = bronze.raw_data_ingestion()
+    bronze.save_to_S3()
+    bronze.commit_fingerprints()
+    bronze.load_unabsorbed()
+    profiler = ProfileLayer(conn)
+    profiler.profile_layer('bronze', 'bronze_heart_disease')
 
-    silver = SilverLayer(conn)
+    silver = SilverLayer(conn, storage)
     silver.data_cleaning_and_standardization()
+    profiler.profile_layer('silver', 'silver_heart_disease')
     silver.display_quality_report()
+    if bronze.deduplicate:
+        silver.merge_previous_snapshot()
     silver.display_age_group_distribution()
     silver.save_to_S3()
 
-    print("\n Silver Layer processing completed successfully.")
+    logger.info("Silver Layer processing completed successfully.")
     bronze.close()
 
 if __name__ == "__main__":
@@ -0,0 +1,69 @@
+# Object Metadata -- concurrent HEAD and LIST calls against the storage backend, cached per run
+
+import os
+import sys
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import config
+
+
+class ObjectMetadata:
+    """Runs storage head() and list_prefix() calls concurrently on an asyncio loop.
+
+    The blocking backend calls run on a thread pool sized to max_concurrency, and a
+    semaphore keeps at most that many in flight. With S3Storage they all share one
+    pooled client. Results are cached for the lifetime of the object, so create one
+    per pipeline run.
+    """
+
+    def __init__(self, storage, max_concurrency=None):
+        self.storage = storage
+        self.max_concurrency = max_concurrency or config.METADATA_MAX_CONCURRENCY
+        self.heads = {}
+        self.listings = {}
+
+    async def _call(self, executor, semaphore, function, *args):
+        async with semaphore:
+            return await asyncio.get_running_loop().run_in_executor(executor, function, *args)
+
+    async def _head_many(self, bucket, keys):
+        missing = [key for key in dict.fromkeys(keys) if (bucket, key) not in self.heads]
+        if missing:
+            semaphore = asyncio.Semaphore(self.max_concurrency)
+            with ThreadPoolExecutor(max_workers=self.max_concurrency) as executor:
+                entries = await asyncio.gather(
+                    *[self._call(executor, semaphore, self.storage.head, bucket, key) for key in missing])
+            for key, entry in zip(missing, entries):
+                self.heads[(bucket, key)] = entry
+        return dict((key, self.heads[(bucket, key)]) for key in keys)
+
+    async def _list_many(self, bucket, prefixes, refresh):
+        missing = [prefix for prefix in dict.fromkeys(prefixes) if refresh or (bucket, prefix) not in self.listings]
+        if missing:
+            semaphore = asyncio.Semaphore(self.max_concurrency)
+            with ThreadPoolExecutor(max_workers=self.max_concurrency) as executor:
+                listings = await asyncio.gather(
+                    *[self._call(executor, semaphore, self.storage.list_prefix, bucket, prefix) for prefix in missing])
+            for prefix, entries in zip(missing, listings):
+                self.listings[(bucket, prefix)] = entries
+                # A listing answers the HEAD of every object in it
+                for entry in entries:
+                    self.heads[(bucket, entry['key'])] = entry
+        return dict((prefix, self.listings[(bucket, prefix)]) for prefix in prefixes)
+
+    def head_many(self, bucket, keys):
+        """Map each key to its head() entry, None for missing objects"""
+        return asyncio.run(self._head_many(bucket, list(keys)))
+
+    def head(self, bucket, key):
+        return self.head_many(bucket, [key])[key]
+
+    def list_prefixes(self, bucket, prefixes, refresh=False):
+        """Map each prefix to its list_prefix() entries"""
+        return asyncio.run(self._list_many(bucket, list(prefixes), refresh))
+
+    def invalidate(self, bucket=None):
+        for cache in (self.heads, self.listings):
+            for cached in [cached for cached in cache if bucket is None or cached[0] == bucket]:
+                del cache[cached]
@@ -1,120 +1,266 @@
 import sys
 import os
+import time
+import logging
 from datetime import datetime
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 from dotenv import load_dotenv
 from Bronze import BronzeLayer
 from Silver import SilverLayer  
 from Gold import GoldLayer
+from Profile import ProfileLayer
+from storage import get_storage
+from snapshot import SnapshotTable
+from streaming import MicroBatchStream
+from service import publish_database
 import config
 
+logger = logging.getLogger(__name__)
+
 class Warehouse_Pipeline:
-    def __init__(self):
+    def __init__(self, storage=None, dataset=None, conn=None):
+        self.storage = storage or get_storage()
+        self.dataset = dataset or config.get_default_dataset()
+        self.conn = conn
+        self.stage_timings = {}
+        self.row_counts = {}
+        self.error = None
         self.bronze = None
         self.silver = None
         self.gold = None
+        self.profiler = None
         self.start_time = None
         self.end_time = None
     
     def run(self, save_to_S3=True, export_to_powerbi=True):
         self.start_time = datetime.now()
-        print("\n the warehouse pipeline is starting...")
-        print("\n Start Time: " + self.start_time.strftime("%Y-%m-%d %H:%M:%S"))
-        print("\n Warehouse location: s3://" + config.TARGET_BUCKET + "/" + config.TARGET_BASE_FILE + "/")
+        # Production mode skips profiles, samples and display tables, nobody reads them there
+        diagnostics = not config.PRODUCTION_MODE
+        logger.info("The warehouse pipeline is starting at " + self.start_time.strftime("%Y-%m-%d %H:%M:%S") +
+                    ", warehouse location: " + self.storage.uri(self.dataset.target_bucket, self.dataset.target_base_file + "/"))
 
         try:
-            print("\n Stage1: Executing Bronze Layer")
-            self.bronze = BronzeLayer()
+            logger.info("Stage 1: Executing Bronze Layer")
+            stage_start = time.perf_counter()
+            self.bronze = BronzeLayer(self.storage, dataset=self.dataset, conn=self.conn)
             conn = self.bronze.raw_data_ingestion()
+            self.row_counts['bronze'] = self.bronze.record_count
+            self.row_counts['bronze_duplicates'] = self.bronze.duplicates_dropped
             if save_to_S3:
                 self.bronze.save_to_S3()
-                print("\n Bronze Layer data is being saved to S3.")
+                self.bronze.commit_fingerprints()
+            # Silver also takes the stored Bronze rows it has not absorbed yet
+            self.row_counts['bronze_unabsorbed'] = self.bronze.load_unabsorbed()
+            if diagnostics:
+                self.profiler = ProfileLayer(conn)
+                self.profiler.profile_layer('bronze', 'bronze_heart_disease')
+            stage_start = self._record_stage('bronze', stage_start)
 
-            print("\n Stage 2: Executing Silver Layer")
-            self.silver = SilverLayer(conn)
+            logger.info("Stage 2: Executing Silver Layer")
+            self.silver = SilverLayer(conn, self.storage, self.dataset)
             self.silver.data_cleaning_and_standardization()
-            self.silver.display_quality_report()
-            self.silver.display_age_group_distribution()
+            self.row_counts['silver'] = self.silver.record_count
+            if diagnostics:
+                # Profiled before the merge, so both profiles cover the rows of this run
+                self.profiler.profile_layer('silver', 'silver_heart_disease')
+                self.silver.display_quality_report()
+            if self.bronze.deduplicate:
+                # Bronze held only new rows, Gold is computed over them plus the stored Silver
+                self.silver.merge_previous_snapshot()
+            if diagnostics:
+                self.silver.display_age_group_distribution()
             if save_to_S3:
                 self.silver.save_to_S3()
-                print("\n Silver Layer data is being saved to S3.")
+            stage_start = self._record_stage('silver', stage_start)
             
-            print("\n Stage 3: Executing Gold Layer")
-            self.gold = GoldLayer(conn)
+            logger.info("Stage 3: Executing Gold Layer")
+            self.gold = GoldLayer(conn, self.storage, self.dataset)
             self.gold.create_aggregations()
-            self.gold.display_demo()
-            self.gold.display_top_risk()
-            self.gold.display_severity_distribution()
+            if diagnostics:
+                self.gold.display_demo()
+                self.gold.display_top_risk()
+                self.gold.display_severity_distribution()
             if save_to_S3:
                 self.gold.save_to_S3()
-                print("\n Gold Layer data is being saved to S3.")
 
             if export_to_powerbi:
                 powerbi_path = self.gold.for_powerbi()
-                print("\n Curated data for PowerBI is being saved to S3. " + powerbi_path)
+                logger.info("Curated data for PowerBI is saved to " + powerbi_path)
 
-            self.gold.display_all_records()
+            if diagnostics:
+                self.gold.display_all_records()
+            stage_start = self._record_stage('gold', stage_start)
+            self.publish(conn)
+            self._record_stage('publish', stage_start)
 
             self.end_time = datetime.now()
             duration = self.end_time - self.start_time
-            print("\n Warehouse pipeline completed successfully.")
-            print("\n Start Time: " + self.start_time.strftime("%Y-%m-%d %H:%M:%S"))
-            print("\n End Time: " + self.end_time.strftime("%Y-%m-%d %H:%M:%S"))
-            print("\n Duration: " + str(duration))
+            logger.info("Warehouse pipeline completed successfully. Start Time: " + self.start_time.strftime("%Y-%m-%d %H:%M:%S") +
+                        ", End Time: " + self.end_time.strftime("%Y-%m-%d %H:%M:%S") + ", Duration: " + str(duration),
+                        extra={'stage_seconds': self.stage_timings, 'row_counts': self.row_counts})
 
             return True
 
         except Exception as e:
-            print("\n Error during warehouse pipeline execution: " + str(e))
-            print("\n The pipeline terminated with errors. Please check the logs for details.")
-            import traceback
-            traceback.print_exc()
+            self.error = str(e)
+            logger.exception("Error during warehouse pipeline execution: " + str(e))
             return False
         
         finally:
             if self.bronze:
                 self.bronze.close()
-            print("\n Warehouse pipeline execution finished.")
+            logger.info("Warehouse pipeline execution finished.")
+
+    def _record_stage(self, stage, stage_start):
+        now = time.perf_counter()
+        self.stage_timings[stage] = now - stage_start
+        return now
+
+    def publish(self, conn):
+        if not config.SERVICE_DATABASE:
+            return None
+        path = config.SERVICE_DATABASE
+        if self.dataset.name != 'default':
+            base, extension = os.path.splitext(path)
+            path = base + "_" + self.dataset.name + extension
+        logger.info("Publishing Silver and Gold tables for the query service")
+        return publish_database(conn, ['silver_heart_disease'] + self.gold.gold_tables, path)
 
     def run_bronze_layer(self):
-        print("\n Running Bronze Layer independently...")
-        self.bronze = BronzeLayer()
+        logger.info("Running Bronze Layer independently...")
+        self.bronze = BronzeLayer(self.storage, dataset=self.dataset, conn=self.conn)
         conn = self.bronze.raw_data_ingestion()
         self.bronze.save_to_S3()
+        # The next Silver run absorbs these rows from the Bronze snapshot
+        self.bronze.commit_fingerprints()
         self.bronze.close()
 
     def run_silver_layer(self):
-        self.bronze = BronzeLayer()
+        self.bronze = BronzeLayer(self.storage, dataset=self.dataset, conn=self.conn)
         conn = self.bronze.raw_data_ingestion()
-        print("\n Running Silver Layer independently...")
-        self.silver = SilverLayer(conn)
+        # Silver appends only the rows new to Bronze, so Bronze is exported as well
+        self.bronze.save_to_S3()
+        self.bronze.commit_fingerprints()
+        self.bronze.load_unabsorbed()
+        logger.info("Running Silver Layer independently...")
+        self.silver = SilverLayer(conn, self.storage, self.dataset)
         self.silver.data_cleaning_and_standardization()
-        self.silver.display_quality_report()
-        self.silver.display_age_group_distribution()
+        if not config.PRODUCTION_MODE:
+            self.profiler = ProfileLayer(conn)
+            self.profiler.profile_layer('bronze', 'bronze_heart_disease')
+            self.profiler.profile_layer('silver', 'silver_heart_disease')
+            self.silver.display_quality_report()
+        if self.bronze.deduplicate:
+            self.silver.merge_previous_snapshot()
+        if not config.PRODUCTION_MODE:
+            self.silver.display_age_group_distribution()
         self.silver.save_to_S3()
         self.bronze.close()
 
+    def run_gold_layer(self, silver_path=None, silver_snapshot=None, save_to_S3=True, export_to_powerbi=True):
+        logger.info("Running Gold Layer independently from exported Silver Parquet...")
+        self.bronze = BronzeLayer(self.storage, dataset=self.dataset, conn=self.conn)
+        conn = self.bronze.init_connection()
+        try:
+            self.gold = GoldLayer(conn, self.storage, self.dataset)
+            self.gold.load_silver_from_parquet(silver_path, snapshot_id=silver_snapshot)
+            self.gold.create_aggregations()
+            if not config.PRODUCTION_MODE:
+                self.gold.display_demo()
+                self.gold.display_top_risk()
+                self.gold.display_severity_distribution()
+            if save_to_S3:
+                self.gold.save_to_S3()
+            if export_to_powerbi:
+                self.gold.for_powerbi()
+            self.publish(conn)
+        finally:
+            self.bronze.close()
+
+    def compact(self, layers=('bronze', 'silver')):
+        logger.info("Compacting small files of the " + ", ".join(layers) + " layers...")
+        prefixes = {'bronze': self.dataset.bronze_prefix, 'silver': self.dataset.silver_prefix}
+        self.bronze = BronzeLayer(self.storage, dataset=self.dataset, conn=self.conn)
+        conn = self.bronze.init_connection()
+        try:
+            for layer in layers:
+                for table_name in config.COMPACTION_TABLES[layer]:
+                    table = SnapshotTable(table_name, prefixes[layer], self.storage, self.dataset.target_bucket)
+                    if table.pointer() is None:
+                        logger.info("No snapshot of {} to compact.".format(table_name))
+                        continue
+                    before = len(table.manifest()['files'])
+                    manifest = table.compact(conn, config.CLUSTER_KEYS.get(table_name))
+                    if manifest is None:
+                        logger.info("{}: {} files, nothing to compact.".format(table_name, str(before)))
+                        continue
+                    logger.info("{}: compacted {} files into {} as snapshot {} ({} records)".format(
+                        table_name, str(before), str(len(manifest['files'])), manifest['snapshot_id'],
+                        str(manifest['row_count'])))
+                    table.expire_snapshots()
+        finally:
+            self.bronze.close()
+
+    def run_stream(self, max_batches=None, save_to_S3=True):
+        stream = MicroBatchStream(self.storage, save_to_S3=save_to_S3)
+        try:
+            return stream.run(max_batches=max_batches)
+        finally:
+            stream.close()
+
 def main():
     import argparse
     load_dotenv()
 
     parser = argparse.ArgumentParser(description="Running an ETL pipeline for the heart disease dataset")
 
-    parser.add_argument('--layer', choices=['bronze', 'silver', 'full'], default = 'full', 
-                        help="Which layer to run: 'bronze' for just the Bronze layer, 'silver' for Bronze + Silver, 'full' for the entire pipeline")
+    parser.add_argument('--layer', choices=['bronze', 'silver', 'gold', 'full', 'stream', 'compact'], default = 'full', 
+                        help="Which layer to run: 'bronze' for just the Bronze layer, 'silver' for Bronze + Silver, 'gold' for Gold from the exported Silver Parquet, 'full' for the entire pipeline, 'stream' to process landing files in micro-batches, 'compact' to merge small files of the stored layers")
+    parser.add_argument('--compact-layers', default='bronze,silver',
+                        help="Comma-separated layers for '--layer compact' (bronze, silver)")
+    parser.add_argument('--silver-path', default=None,
+                        help="Local path or s3:// URI of a Silver Parquet file for '--layer gold' (defaults to the current Silver snapshot)")
+    parser.add_argument('--silver-snapshot', default=None,
+                        help="Silver snapshot id for '--layer gold', to rebuild Gold from an older version")
+    parser.add_argument('--max-batches', type=int, default=None,
+                        help="Stop '--layer stream' after this many micro-batches (runs until interrupted by default)")
+    parser.add_argument('--datasets', default=None,
+                        help="JSON file listing datasets to run concurrently in one process (full pipeline per dataset)")
     parser.add_argument('--no-s3', action='store_true', help="Skip S3 upload steps and save all outputs locally")
     parser.add_argument('--no-powerbi', action='store_true', help="Skip exporting curated data for PowerBI")
+    parser.add_argument('--production', action='store_true',
+                        help="Skip diagnostic queries (samples, counts, profiles, display tables) and log JSON lines")
 
     args = parser.parse_args()
-    config.validate_config()
+    if args.production:
+        config.PRODUCTION_MODE = True
+    config.configure_logging(log_format='json' if args.production else None)
+    config.validate_config(layer=args.layer)
     pipeline = Warehouse_Pipeline()
 
-    if args.layer == 'bronze':
+    if args.datasets:
+        from runner import MultiDatasetRunner
+        runner = MultiDatasetRunner(config.load_dataset_configs(args.datasets), pipeline.storage)
+        if not runner.run(save_to_S3=not args.no_s3, export_to_powerbi=not args.no_powerbi):
+            sys.exit(1)
+    elif args.layer == 'bronze':
         pipeline.run_bronze_layer()
     elif args.layer == 'silver':
         pipeline.run_silver_layer()
+    elif args.layer == 'gold':
+        pipeline.run_gold_layer(silver_path=args.silver_path, silver_snapshot=args.silver_snapshot, save_to_S3=not args.no_s3,
+                                export_to_powerbi=not args.no_powerbi)
+    elif args.layer == 'compact':
+        layers = [layer.strip() for layer in args.compact_layers.split(',') if layer.strip()]
+        unknown = [layer for layer in layers if layer not in config.COMPACTION_TABLES]
+        if unknown:
+            parser.error("Unknown layers for compaction: " + ", ".join(unknown))
+        pipeline.compact(layers)
+    elif args.layer == 'stream':
+        pipeline.run_stream(max_batches=args.max_batches, save_to_S3=not args.no_s3)
     else: 
-        pipeline.run(save_to_S3=not args.no_s3, export_to_powerbi=not args.no_powerbi)
+        if not pipeline.run(save_to_S3=not args.no_s3, export_to_powerbi=not args.no_powerbi):
+            sys.exit(1)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,93 @@
+# Multi-dataset Runner -- run the pipeline for several datasets concurrently in one process
+
+import os
+import sys
+import time
+import logging
+from concurrent.futures import ThreadPoolExecutor
+import duckdb
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import config
+from storage import get_storage
+from pipeline import Warehouse_Pipeline
+
+logger = logging.getLogger(__name__)
+
+
+class MultiDatasetRunner:
+    """Runs the full pipeline for a list of DatasetConfig on one shared DuckDB instance.
+
+    httpfs and the storage secret are set up once. Each dataset gets its own cursor and
+    schema, so table names never collide. DuckDB's threads and memory_limit are
+    instance-wide, which makes them the shared worker and memory budget for all
+    datasets running at the same time.
+    """
+
+    def __init__(self, datasets, storage=None, max_concurrent=None, threads=None, memory_limit=None):
+        self.datasets = datasets
+        self.storage = storage or get_storage()
+        self.max_concurrent = max_concurrent or config.RUNNER_MAX_CONCURRENT_DATASETS
+        self.threads = threads or config.RUNNER_THREADS
+        self.memory_limit = memory_limit or config.RUNNER_MEMORY_LIMIT
+        self.conn = None
+        self.metrics = []
+
+    def _init_duckdb(self):
+        self.conn = duckdb.connect(config.DUCKDB_DATABASE)
+        self.conn.execute("SET threads = {}".format(int(self.threads)))
+        self.conn.execute("SET memory_limit = '{}'".format(self.memory_limit.replace("'", "")))
+        self.storage.configure_duckdb(self.conn)
+        logger.info("Shared DuckDB instance: {} threads, {} memory for up to {} concurrent datasets.".format(
+            str(self.threads), self.memory_limit, str(self.max_concurrent)))
+        return self.conn
+
+    def _cursor_for(self, dataset):
+        cursor = self.conn.cursor()
+        # Quoted, so names that are SQL keywords (select, order, ...) still work as schemas, and
+        # qualified, so a name equal to the database's own name is not taken for the catalog
+        catalog = cursor.execute("SELECT current_database()").fetchone()[0]
+        schema = '"' + catalog.replace('"', '""') + '"."' + dataset.name + '"'
+        cursor.execute("CREATE SCHEMA IF NOT EXISTS " + schema)
+        cursor.execute("USE " + schema)
+        return cursor
+
+    def _run_dataset(self, dataset, cursor, save_to_S3, export_to_powerbi):
+        started = time.perf_counter()
+        pipeline = Warehouse_Pipeline(self.storage, dataset, cursor)
+        succeeded = pipeline.run(save_to_S3=save_to_S3, export_to_powerbi=export_to_powerbi)
+        return {
+            'dataset': dataset.name,
+            'status': 'succeeded' if succeeded else 'failed',
+            'error': pipeline.error,
+            'duration_seconds': time.perf_counter() - started,
+            'stage_seconds': dict(pipeline.stage_timings),
+            'bronze_rows': pipeline.row_counts.get('bronze'),
+            'bronze_duplicates': pipeline.row_counts.get('bronze_duplicates'),
+            'silver_rows': pipeline.row_counts.get('silver')
+        }
+
+    def run(self, save_to_S3=True, export_to_powerbi=True):
+        self._init_duckdb()
+        started = time.perf_counter()
+        try:
+            # Cursors are created up front, a connection must not be used from several threads at once
+            cursors = [self._cursor_for(dataset) for dataset in self.datasets]
+            with ThreadPoolExecutor(max_workers=self.max_concurrent) as executor:
+                futures = [executor.submit(self._run_dataset, dataset, cursor, save_to_S3, export_to_powerbi)
+                           for dataset, cursor in zip(self.datasets, cursors)]
+                self.metrics = [future.result() for future in futures]
+        finally:
+            self.conn.close()
+
+        self.display_metrics(time.perf_counter() - started)
+        return all(metric['status'] == 'succeeded' for metric in self.metrics)
+
+    def display_metrics(self, total_seconds):
+        logger.info("Multi-dataset run summary ({:.2f}s total)".format(total_seconds))
+        for metric in self.metrics:
+            stages = ", ".join("{} {:.2f}s".format(stage, seconds) for stage, seconds in metric['stage_seconds'].items())
+            logger.info("  - {}: {} in {:.2f}s, bronze {} rows ({} duplicates dropped), silver {} rows ({})".format(
+                metric['dataset'], metric['status'], metric['duration_seconds'], str(metric['bronze_rows']),
+                str(metric['bronze_duplicates']), str(metric['silver_rows']), stages), extra={'run_metrics': metric})
+            if metric['error']:
+                logger.error("  - {} failed: {}".format(metric['dataset'], metric['error']))
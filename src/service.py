@@ -0,0 +1,284 @@
+# Query Service -- read-only HTTP access to the published Gold and Silver tables
+
+import os
+import sys
+import json
+import logging
+import queue
+import threading
+import uuid
+from collections import OrderedDict
+from datetime import datetime, date
+from decimal import Decimal
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+import duckdb
+from dotenv import load_dotenv
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import config
+
+logger = logging.getLogger(__name__)
+
+
+def _pointer_path(path):
+    return path + ".current"
+
+
+def _version_path(path, version):
+    base, extension = os.path.splitext(path)
+    return base + "-" + version + extension
+
+
+def current_database(path):
+    """The versioned database file the pointer of `path` names, None before the first publish"""
+    pointer = _pointer_path(path)
+    if not os.path.exists(pointer):
+        return None
+    with open(pointer) as f:
+        return os.path.join(os.path.dirname(os.path.abspath(path)), f.read().strip())
+
+
+def publish_database(conn, tables, path=None):
+    """Copy tables into a new versioned DuckDB file and point `path` at it.
+
+    Each publish writes <base>-<version><ext> next to `path` and then swaps the
+    <path>.current pointer, so the service keeps answering from the previous file until
+    it notices the new version. The previous file is kept for in-flight readers, older
+    ones are removed.
+    """
+    path = path or config.SERVICE_DATABASE
+    if not path:
+        raise ValueError("SERVICE_DATABASE must be set to publish tables for the query service.")
+    path = os.path.abspath(path)
+    version = datetime.now().strftime('%Y%m%d%H%M%S') + "-" + uuid.uuid4().hex[:8]
+    version_path = _version_path(path, version)
+    previous = current_database(path)
+
+    # Attached databases are visible to every connection of the instance, keep aliases unique
+    alias = "publish_" + uuid.uuid4().hex[:8]
+    conn.execute("ATTACH '" + version_path.replace("'", "''") + "' AS " + alias)
+    try:
+        for table_name in tables:
+            if not table_name.replace('_', '').isalnum():
+                raise ValueError("Invalid table name: " + table_name)
+            conn.execute("CREATE TABLE {0}.{1} AS SELECT * FROM {1}".format(alias, table_name))
+        conn.execute("CREATE TABLE " + alias + ".publish_info AS SELECT ? AS version, CURRENT_TIMESTAMP AS published_at",
+                     [version])
+    finally:
+        conn.execute("DETACH " + alias)
+
+    pointer = _pointer_path(path)
+    with open(pointer + ".tmp", 'w') as f:
+        f.write(os.path.basename(version_path))
+    os.replace(pointer + ".tmp", pointer)
+
+    base, extension = os.path.splitext(os.path.basename(path))
+    directory = os.path.dirname(path)
+    for file_name in os.listdir(directory):
+        stale = os.path.join(directory, file_name)
+        if (file_name.startswith(base + "-") and file_name.endswith(extension)
+                and stale not in (version_path, previous)):
+            os.remove(stale)
+    logger.info("Published " + str(len(tables)) + " tables to " + version_path + " as version " + version)
+    return version
+
+
+def _json_default(value):
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    if isinstance(value, Decimal):
+        return float(value)
+    return str(value)
+
+
+class ResultCache:
+    """LRU cache of query results keyed on (data version, sql, params)"""
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return self.entries[key]
+            self.misses += 1
+            return None
+
+    def put(self, key, value):
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+class ReadOnlyPool:
+    """A pool of read-only cursors on the published database.
+
+    When a new publish moves the pointer, the next acquire opens the new versioned
+    file, and cursors of the old generation are closed as they are released. External
+    access is disabled, so served queries cannot read files or URLs.
+    """
+
+    def __init__(self, path, size):
+        self.path = path
+        self.size = size
+        self.lock = threading.Lock()
+        self.db = None
+        self.database_path = None
+        self.version = None
+        self.generation = 0
+        self.idle = queue.LifoQueue()
+        self.slots = threading.BoundedSemaphore(size)
+
+    def refresh(self):
+        """Open the database the pointer names if it changed, returns True when the version changed"""
+        database_path = current_database(self.path)
+        with self.lock:
+            if database_path == self.database_path:
+                return False
+            db = duckdb.connect(database_path, read_only=True, config={'enable_external_access': False})
+            version = db.execute("SELECT version FROM publish_info").fetchone()[0]
+            # The previous database stays open until its in-flight cursors are released
+            self.db = db
+            self.database_path = database_path
+            self.version = version
+            self.generation += 1
+            while not self.idle.empty():
+                self.idle.get_nowait()[2].close()
+        return True
+
+    def acquire(self):
+        self.slots.acquire()
+        with self.lock:
+            if not self.idle.empty():
+                return self.idle.get_nowait()
+            return (self.generation, self.version, self.db.cursor())
+
+    def release(self, entry):
+        with self.lock:
+            if entry[0] == self.generation:
+                self.idle.put(entry)
+            else:
+                entry[2].close()
+        self.slots.release()
+
+
+class QueryService:
+    def __init__(self, path=None, pool_size=None, cache_size=None):
+        self.path = path or config.SERVICE_DATABASE
+        if not self.path or current_database(self.path) is None:
+            raise ValueError("Published database not found, run the pipeline with SERVICE_DATABASE set first.")
+        self.pool = ReadOnlyPool(self.path, pool_size or config.SERVICE_POOL_SIZE)
+        self.cache = ResultCache(cache_size or config.SERVICE_CACHE_SIZE)
+        self.pool.refresh()
+
+    def execute(self, sql, params=None):
+        statement = sql.strip().rstrip(';')
+        if not statement.lower().startswith(('select', 'with')):
+            raise ValueError("Only SELECT queries are served.")
+        if self.pool.refresh():
+            self.cache.clear()
+
+        entry = self.pool.acquire()
+        try:
+            generation, version, cursor = entry
+            key = (version, statement, tuple(params or []))
+            cached = self.cache.get(key)
+            if cached is not None:
+                return dict(cached, cached=True)
+            result = cursor.execute(statement, params or [])
+            columns = [column[0] for column in result.description]
+            rows = result.fetchall()
+        finally:
+            self.pool.release(entry)
+
+        response = {'version': version, 'columns': columns, 'rows': rows, 'row_count': len(rows)}
+        self.cache.put(key, response)
+        return dict(response, cached=False)
+
+    def tables(self):
+        return self.execute("SELECT table_name FROM information_schema.tables WHERE table_name <> 'publish_info' ORDER BY table_name")
+
+    def table(self, table_name, limit=None):
+        if not table_name.replace('_', '').isalnum():
+            raise ValueError("Invalid table name: " + table_name)
+        sql = "SELECT * FROM " + table_name
+        if limit is not None:
+            sql += " LIMIT " + str(int(limit))
+        return self.execute(sql)
+
+
+def make_handler(service):
+    class QueryHandler(BaseHTTPRequestHandler):
+        def _send(self, status, payload):
+            body = json.dumps(payload, default=_json_default).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            url = urlparse(self.path)
+            query = parse_qs(url.query)
+            try:
+                if url.path == '/health':
+                    service.pool.refresh()
+                    self._send(200, {'status': 'ok', 'version': service.pool.version,
+                                     'cache_hits': service.cache.hits, 'cache_misses': service.cache.misses})
+                elif url.path == '/tables':
+                    self._send(200, service.tables())
+                elif url.path.startswith('/tables/'):
+                    limit = query.get('limit', [None])[0]
+                    self._send(200, service.table(url.path[len('/tables/'):], limit))
+                elif url.path == '/query':
+                    if 'sql' not in query:
+                        self._send(400, {'error': "Missing 'sql' parameter"})
+                        return
+                    self._send(200, service.execute(query['sql'][0], query.get('param')))
+                else:
+                    self._send(404, {'error': 'Not found'})
+            except (ValueError, duckdb.Error) as e:
+                self._send(400, {'error': str(e)})
+
+        def log_message(self, format, *args):
+            pass
+
+    return QueryHandler
+
+
+def main():
+    import argparse
+    load_dotenv()
+    config.configure_logging()
+
+    parser = argparse.ArgumentParser(description="Read-only query service over the published Gold and Silver tables")
+    parser.add_argument('--database', default=None, help="Published database path, the pointer <path>.current names the served file (defaults to SERVICE_DATABASE)")
+    parser.add_argument('--host', default=config.SERVICE_HOST)
+    parser.add_argument('--port', type=int, default=config.SERVICE_PORT)
+    args = parser.parse_args()
+
+    service = QueryService(args.database)
+    server = ThreadingHTTPServer((args.host, args.port), make_handler(service))
+    logger.info("Serving " + service.path + " (version " + str(service.pool.version) + ") on http://" +
+                args.host + ":" + str(args.port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        logger.info("Query service stopped.")
+    finally:
+        server.server_close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,302 @@
+# Snapshot Tables -- immutable data files plus a manifest per version of a table
+
+import os
+import sys
+import json
+import uuid
+import shutil
+import tempfile
+from datetime import datetime, date, timezone
+from decimal import Decimal
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import config
+from storage import get_storage
+
+SCALAR_EXCLUDED = ('[', 'STRUCT', 'MAP', 'UNION', 'BLOB')
+
+
+def _json_value(value):
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    if isinstance(value, Decimal):
+        return float(value)
+    return value
+
+
+def cluster_order_by(table_name):
+    """ORDER BY clause for a table's CLUSTER_KEYS, empty when it has none"""
+    keys = config.CLUSTER_KEYS.get(table_name) or []
+    for key in keys:
+        if not key.replace('_', '').isalnum():
+            raise ValueError("Invalid cluster key for " + table_name + ": " + key)
+    return "ORDER BY " + ", ".join(keys) if keys else ""
+
+
+class SnapshotTable:
+    """A table stored as immutable Parquet data files and one manifest per snapshot.
+
+    Layout under <prefix><table>/:
+        data/<snapshot_id>-<n>.parquet   data files, never overwritten
+        metadata/<snapshot_id>.json      manifest: files with row counts and column min/max
+        metadata/_current.json           pointer to the current snapshot, plus the history
+
+    A commit uploads data files and the manifest first and swaps the pointer last, so
+    readers see either the old or the new snapshot. Readers resolve files from the
+    pointer and manifest, without listing the prefix.
+    """
+
+    def __init__(self, table_name, prefix, storage=None, bucket=None):
+        self.table_name = table_name
+        self.storage = storage or get_storage()
+        self.bucket = bucket or config.TARGET_BUCKET
+        self.base_key = prefix + table_name + "/"
+        self.pointer_key = self.base_key + "metadata/_current.json"
+
+    def _manifest_key(self, snapshot_id):
+        return self.base_key + "metadata/" + snapshot_id + ".json"
+
+    def _read_json(self, key):
+        return json.loads(self.storage.read_bytes(self.bucket, key).decode('utf-8'))
+
+    def _write_json(self, document, key):
+        self.storage.write_bytes(json.dumps(document, indent=2, default=str).encode('utf-8'), self.bucket, key)
+
+    def pointer(self):
+        if not self.storage.exists(self.bucket, self.pointer_key):
+            return None
+        return self._read_json(self.pointer_key)
+
+    def manifest(self, snapshot_id=None, as_of=None):
+        """Manifest of the current snapshot, a given snapshot_id, or the last one committed at or before as_of"""
+        pointer = self.pointer()
+        if pointer is None:
+            raise ValueError("No snapshots found for table " + self.table_name)
+        if as_of is not None:
+            as_of = as_of.isoformat() if isinstance(as_of, datetime) else as_of
+            candidates = [entry for entry in pointer['history'] if entry['created_at'] <= as_of]
+            if not candidates:
+                raise ValueError("No snapshot of " + self.table_name + " exists at " + as_of)
+            snapshot_id = candidates[-1]['snapshot_id']
+        return self._read_json(self._manifest_key(snapshot_id or pointer['snapshot_id']))
+
+    def _file_stats(self, conn, local_file):
+        """Row count and per-column min/max/null count, read from the Parquet footer.
+
+        Row-group statistics are stored as strings; they are cast back to each column's
+        type before taking the file-wide min/max. A bound stays None when a row group
+        holding values has no statistics for the column.
+        """
+        literal = "'" + local_file.replace("'", "''") + "'"
+        columns = conn.execute("DESCRIBE SELECT * FROM read_parquet({})".format(literal)).fetchall()
+        columns = [(name, col_type) for name, col_type, *_ in columns
+                   if not any(marker in col_type.upper() for marker in SCALAR_EXCLUDED)]
+        expressions = []
+        for name, col_type in columns:
+            where = " FILTER (WHERE path_in_schema = '" + name.replace("'", "''") + "')"
+            complete = "BOOL_AND({} IS NOT NULL OR stats_null_count = row_group_num_rows)" + where
+            for bound, aggregate in (('stats_min_value', 'MIN'), ('stats_max_value', 'MAX')):
+                value = "{}(TRY_CAST({} AS {})){}".format(aggregate, bound, col_type, where)
+                if 'WITH TIME ZONE' in col_type.upper():
+                    # Kept as naive UTC, fetching zone-aware values needs pytz
+                    value = "timezone('UTC', " + value + ")"
+                expressions.append("CASE WHEN {} THEN {} END".format(complete.format(bound), value))
+            expressions.append("SUM(stats_null_count)" + where)
+        row = conn.execute("SELECT " + ", ".join(expressions or ["NULL"]) +
+                           " FROM parquet_metadata({})".format(literal)).fetchone()
+        row_count = conn.execute("SELECT num_rows FROM parquet_file_metadata({})".format(literal)).fetchone()[0]
+
+        column_stats = {}
+        for i, (name, _) in enumerate(columns):
+            column_stats[name] = {
+                'min': _json_value(row[3 * i]),
+                'max': _json_value(row[1 + 3 * i]),
+                'null_count': int(row[2 + 3 * i] or 0)
+            }
+        return row_count, column_stats
+
+    def commit(self, conn, source_sql, mode='overwrite', staging_dir=None, operation=None, replaces=None, properties=None):
+        """Write the rows of source_sql as a new snapshot.
+
+        mode 'overwrite' replaces all files, 'append' keeps the parent's files. `replaces`
+        lists data file keys dropped from the parent, which is how compaction swaps files.
+        `properties` is a JSON-serializable dict kept in the manifest, the parent's is
+        carried over when it is not given.
+        """
+        if mode not in ('overwrite', 'append'):
+            raise ValueError("Invalid snapshot mode: " + mode)
+
+        parent = self.pointer()
+        parent_manifest = self.manifest(parent['snapshot_id']) if parent is not None else None
+        parent_files = []
+        if parent is not None and (mode == 'append' or replaces):
+            parent_files = parent_manifest['files']
+            missing = set(replaces or []) - set(entry['key'] for entry in parent_files)
+            if missing:
+                raise ValueError("Files to replace are no longer in the current snapshot of " + self.table_name + ".")
+        snapshot_id = datetime.now(timezone.utc).strftime('%Y%m%dT%H%M%S%fZ') + "-" + uuid.uuid4().hex[:8]
+        own_staging = staging_dir is None
+        staging_dir = staging_dir or tempfile.mkdtemp(prefix=self.table_name + "_")
+        os.makedirs(staging_dir, exist_ok=True)
+        local_dir = os.path.join(staging_dir, snapshot_id)
+
+        # COPY takes its target as a literal, older DuckDB releases cannot bind it as a parameter
+        conn.execute(
+            "COPY ({}) TO '{}' (FORMAT PARQUET, COMPRESSION SNAPPY, FILE_SIZE_BYTES {}, ROW_GROUP_SIZE {})".format(
+                source_sql, local_dir.replace("'", "''"), int(config.SNAPSHOT_TARGET_FILE_BYTES),
+                int(config.PARQUET_ROW_GROUP_SIZE))
+        )
+
+        files = []
+        for n, file_name in enumerate(sorted(os.listdir(local_dir))):
+            local_file = os.path.join(local_dir, file_name)
+            row_count, column_stats = self._file_stats(conn, local_file)
+            if row_count == 0:
+                continue
+            key = self.base_key + "data/" + snapshot_id + "-" + str(n) + ".parquet"
+            self.storage.write_file(local_file, self.bucket, key)
+            files.append({
+                'key': key,
+                'row_count': row_count,
+                'size_bytes': os.path.getsize(local_file),
+                'column_stats': column_stats
+            })
+
+        if parent_files:
+            dropped = set(replaces or [])
+            files = [entry for entry in parent_files if entry['key'] not in dropped] + files
+
+        created_at = datetime.now(timezone.utc).isoformat()
+        manifest = {
+            'table': self.table_name,
+            'snapshot_id': snapshot_id,
+            'parent_snapshot_id': parent['snapshot_id'] if parent else None,
+            'operation': operation or mode,
+            'created_at': created_at,
+            'row_count': sum(entry['row_count'] for entry in files),
+            'properties': properties if properties is not None else (parent_manifest or {}).get('properties', {}),
+            'files': files
+        }
+        self._write_json(manifest, self._manifest_key(snapshot_id))
+
+        current = self.pointer()
+        if (current and current['snapshot_id']) != (parent and parent['snapshot_id']):
+            raise ValueError("Concurrent commit detected on " + self.table_name + ", snapshot " + snapshot_id + " was not published.")
+        history = (parent['history'] if parent else []) + [{'snapshot_id': snapshot_id, 'created_at': created_at}]
+        self._write_json({'snapshot_id': snapshot_id, 'history': history}, self.pointer_key)
+
+        shutil.rmtree(staging_dir if own_staging else local_dir, ignore_errors=True)
+        return manifest
+
+    def compact(self, conn, cluster_keys=None, small_file_bytes=None, staging_dir=None):
+        """Merge the small data files of the current snapshot into target-sized files.
+
+        Rows are sorted by cluster_keys, and the new files replace the small ones in a
+        single commit. Returns the new manifest, or None when there is nothing to merge.
+        """
+        small_file_bytes = small_file_bytes or config.COMPACTION_SMALL_FILE_BYTES
+        small = [entry for entry in self.manifest()['files'] if entry['size_bytes'] < small_file_bytes]
+        if len(small) < 2:
+            return None
+        for key in cluster_keys or []:
+            if not key.replace('_', '').isalnum():
+                raise ValueError("Invalid cluster key: " + key)
+
+        file_list = ", ".join("'" + self.storage.uri(self.bucket, entry['key']).replace("'", "''") + "'" for entry in small)
+        source_sql = "SELECT * FROM read_parquet([{}])".format(file_list)
+        if cluster_keys:
+            source_sql += " ORDER BY " + ", ".join(cluster_keys)
+        return self.commit(conn, source_sql, staging_dir=staging_dir, operation='compact',
+                           replaces=[entry['key'] for entry in small])
+
+    def files(self, snapshot_id=None, as_of=None, filters=None):
+        """Data file URIs of a snapshot, skipping files whose min/max cannot match filters.
+
+        filters maps a column to (operator, value), with operator one of =, <, <=, >, >=.
+        """
+        manifest = self.manifest(snapshot_id, as_of)
+        selected = []
+        for entry in manifest['files']:
+            if filters and not self._may_match(entry['column_stats'], filters):
+                continue
+            selected.append(self.storage.uri(self.bucket, entry['key']))
+        return selected
+
+    def _may_match(self, column_stats, filters):
+        for column, (operator, value) in filters.items():
+            stats = column_stats.get(column)
+            if stats is None or stats['min'] is None:
+                continue
+            # Manifest bounds of temporal columns are ISO strings, compare filters in the same form
+            value = _json_value(value)
+            low, high = stats['min'], stats['max']
+            try:
+                if operator == '=' and not (low <= value <= high):
+                    return False
+                if operator in ('<', '<=') and (low > value or (operator == '<' and low == value)):
+                    return False
+                if operator in ('>', '>=') and (high < value or (operator == '>' and high == value)):
+                    return False
+            except TypeError:
+                continue
+        return True
+
+    def row_group_selectivity(self, conn, column, snapshot_id=None):
+        """Check the per-row-group min/max of a column in the Parquet footers.
+
+        Returns the number of row groups and the average fraction of them an equality
+        filter on the column still has to read; close to 1/row_groups means well clustered.
+        """
+        uris = self.files(snapshot_id)
+        if not uris:
+            return 0, 0.0
+        file_list = ", ".join("'" + uri.replace("'", "''") + "'" for uri in uris)
+        ranges = conn.execute(
+            "SELECT stats_min_value, stats_max_value FROM parquet_metadata([{}]) WHERE path_in_schema = ?".format(file_list),
+            [column]).fetchall()
+        if any(low is None or high is None for low, high in ranges):
+            return len(ranges), 1.0
+
+        # Footer statistics are strings, compare numbers as numbers
+        try:
+            ranges = [(float(low), float(high)) for low, high in ranges]
+        except ValueError:
+            pass
+        hits = [sum(1 for other_low, other_high in ranges if other_low <= low <= other_high) for low, _ in ranges]
+        return len(ranges), sum(hits) / float(len(ranges) * len(ranges))
+
+    def attach(self, conn, view_name=None, snapshot_id=None, as_of=None, filters=None):
+        """Expose a snapshot to DuckDB as a view over its (pruned) data files"""
+        view_name = view_name or self.table_name
+        if not view_name.replace('_', '').isalnum():
+            raise ValueError("Invalid view name: " + view_name)
+        uris = self.files(snapshot_id, as_of, filters)
+        if not uris:
+            raise ValueError("No data files of " + self.table_name + " match the requested snapshot and filters.")
+        file_list = ", ".join("'" + uri.replace("'", "''") + "'" for uri in uris)
+        conn.execute("CREATE OR REPLACE VIEW {} AS SELECT * FROM read_parquet([{}])".format(view_name, file_list))
+        return uris
+
+    def expire_snapshots(self, retain=None):
+        """Drop snapshots beyond the newest `retain` and delete files only they reference"""
+        retain = retain or config.SNAPSHOT_RETAIN
+        pointer = self.pointer()
+        if pointer is None or len(pointer['history']) <= retain:
+            return 0
+
+        expired = pointer['history'][:-retain]
+        retained = pointer['history'][-retain:]
+        live_keys = set()
+        for entry in retained:
+            live_keys.update(f['key'] for f in self.manifest(entry['snapshot_id'])['files'])
+
+        self._write_json({'snapshot_id': pointer['snapshot_id'], 'history': retained}, self.pointer_key)
+        deleted = 0
+        for entry in expired:
+            manifest_key = self._manifest_key(entry['snapshot_id'])
+            for f in self._read_json(manifest_key)['files']:
+                if f['key'] not in live_keys:
+                    self.storage.delete(self.bucket, f['key'])
+                    live_keys.add(f['key'])
+                    deleted += 1
+            self.storage.delete(self.bucket, manifest_key)
+        return deleted
@@ -0,0 +1,234 @@
+# Storage backends -- where the pipeline reads sources from and writes layers to
+
+import os
+import sys
+import shutil
+import threading
+from datetime import datetime, timezone
+from urllib.parse import urlparse
+import boto3
+from botocore.config import Config
+from botocore.exceptions import ClientError
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import config
+
+
+class StorageBackend:
+    """Common interface for object storage used by every layer.
+
+    Objects are addressed by (bucket, key). `uri` returns a location DuckDB can
+    read from or COPY to directly, the other methods cover metadata and writes.
+    """
+
+    name = None
+
+    def uri(self, bucket, key):
+        raise NotImplementedError
+
+    def head(self, bucket, key):
+        """Return {'key', 'size', 'etag', 'last_modified'} for an object, or None if missing"""
+        raise NotImplementedError
+
+    def list_prefix(self, bucket, prefix):
+        """Return the head() entries of every object under a prefix, sorted by key"""
+        raise NotImplementedError
+
+    def write_file(self, local_path, bucket, key):
+        raise NotImplementedError
+
+    def write_bytes(self, data, bucket, key):
+        raise NotImplementedError
+
+    def read_bytes(self, bucket, key):
+        raise NotImplementedError
+
+    def delete(self, bucket, key):
+        raise NotImplementedError
+
+    def configure_duckdb(self, conn):
+        """Prepare a DuckDB connection to read and write this backend's URIs"""
+        return conn
+
+    def exists(self, bucket, key):
+        return self.head(bucket, key) is not None
+
+
+class S3Storage(StorageBackend):
+    """S3, or any S3-compatible endpoint (MinIO, a moto server) when S3_ENDPOINT_URL is set.
+
+    One client is shared by all threads, its connection pool is sized for the
+    concurrent metadata calls of ObjectMetadata.
+    """
+
+    name = 's3'
+
+    def __init__(self, endpoint_url=None):
+        self.endpoint_url = endpoint_url or config.S3_ENDPOINT_URL
+        self._client = None
+        self._lock = threading.Lock()
+
+    @property
+    def client(self):
+        with self._lock:
+            if self._client is None:
+                self._client = boto3.client(
+                    's3',
+                    aws_access_key_id=config.AWS_ACCESS_KEY_ID,
+                    aws_secret_access_key=config.AWS_SECRET_ACCESS_KEY,
+                    region_name=config.AWS_REGION,
+                    endpoint_url=self.endpoint_url,
+                    config=Config(max_pool_connections=config.S3_MAX_POOL_CONNECTIONS,
+                                  retries={'max_attempts': 5, 'mode': 'adaptive'})
+                )
+        return self._client
+
+    def uri(self, bucket, key):
+        return "s3://" + bucket + "/" + key
+
+    def _entry(self, key, size, etag, last_modified):
+        return {
+            'key': key,
+            'size': size,
+            'etag': etag.strip('"') if etag else None,
+            'last_modified': last_modified
+        }
+
+    def head(self, bucket, key):
+        try:
+            response = self.client.head_object(Bucket=bucket, Key=key)
+        except ClientError as e:
+            if e.response.get('Error', {}).get('Code') in ('404', 'NoSuchKey', 'NotFound'):
+                return None
+            raise
+        return self._entry(key, response['ContentLength'], response.get('ETag'), response.get('LastModified'))
+
+    def list_prefix(self, bucket, prefix):
+        entries = []
+        paginator = self.client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+            for obj in page.get('Contents', []):
+                entries.append(self._entry(obj['Key'], obj['Size'], obj.get('ETag'), obj.get('LastModified')))
+        return sorted(entries, key=lambda entry: entry['key'])
+
+    def write_file(self, local_path, bucket, key):
+        self.client.upload_file(local_path, bucket, key)
+
+    def write_bytes(self, data, bucket, key):
+        self.client.put_object(Bucket=bucket, Key=key, Body=data)
+
+    def read_bytes(self, bucket, key):
+        return self.client.get_object(Bucket=bucket, Key=key)['Body'].read()
+
+    def delete(self, bucket, key):
+        self.client.delete_object(Bucket=bucket, Key=key)
+
+    def configure_duckdb(self, conn):
+        conn.execute('INSTALL httpfs')
+        conn.execute('LOAD httpfs')
+
+        if not config.AWS_ACCESS_KEY_ID or not isinstance(config.AWS_ACCESS_KEY_ID, str):
+            raise ValueError("AWS_ACCESS_KEY_ID must be set in the config file.")
+        if not config.AWS_SECRET_ACCESS_KEY or not isinstance(config.AWS_SECRET_ACCESS_KEY, str):
+            raise ValueError("AWS_SECRET_ACCESS_KEY must be set in the config file.")
+        if not config.AWS_REGION or not isinstance(config.AWS_REGION, str):
+            raise ValueError("Invalid AWS region configuration")
+
+        options = ""
+        params = [config.AWS_ACCESS_KEY_ID, config.AWS_SECRET_ACCESS_KEY, config.AWS_REGION]
+        if self.endpoint_url:
+            endpoint = urlparse(self.endpoint_url)
+            options = """,
+                          ENDPOINT ?,
+                          URL_STYLE 'path',
+                          USE_SSL {}""".format('true' if endpoint.scheme == 'https' else 'false')
+            params.append(endpoint.netloc)
+
+        conn.execute("""
+            CREATE SECRET AWS_credentials (
+                          TYPE S3,
+                          KEY_ID ?,
+                          SECRET ?,
+                          REGION ?{}
+            )
+        """.format(options), params)
+        return conn
+
+
+class LocalStorage(StorageBackend):
+    """Buckets are directories under a root, keys are relative paths inside them"""
+
+    name = 'local'
+
+    def __init__(self, root):
+        if not root:
+            raise ValueError("LOCAL_STORAGE_ROOT must be set for the local storage backend.")
+        self.root = os.path.abspath(root)
+
+    def path(self, bucket, key):
+        path = os.path.abspath(os.path.join(self.root, bucket, key))
+        if not path.startswith(self.root + os.sep):
+            raise ValueError("Storage key escapes the storage root: " + key)
+        return path
+
+    def uri(self, bucket, key):
+        return self.path(bucket, key)
+
+    def head(self, bucket, key):
+        path = self.path(bucket, key)
+        if not os.path.isfile(path):
+            return None
+        stat = os.stat(path)
+        return {
+            'key': key,
+            'size': stat.st_size,
+            'etag': "{:x}-{:x}".format(stat.st_mtime_ns, stat.st_size),
+            'last_modified': datetime.fromtimestamp(stat.st_mtime, tz=timezone.utc)
+        }
+
+    def list_prefix(self, bucket, prefix):
+        bucket_root = self.path(bucket, '.')
+        entries = []
+        for directory, _, files in os.walk(bucket_root):
+            for file_name in files:
+                key = os.path.relpath(os.path.join(directory, file_name), bucket_root).replace(os.sep, '/')
+                if key.startswith(prefix):
+                    entries.append(self.head(bucket, key))
+        return sorted(entries, key=lambda entry: entry['key'])
+
+    def _prepare(self, bucket, key):
+        path = self.path(bucket, key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        return path
+
+    def write_file(self, local_path, bucket, key):
+        path = self._prepare(bucket, key)
+        # Copy next to the target and rename, so readers never see a partial file
+        tmp_path = path + ".tmp"
+        shutil.copyfile(local_path, tmp_path)
+        os.replace(tmp_path, path)
+
+    def write_bytes(self, data, bucket, key):
+        path = self._prepare(bucket, key)
+        tmp_path = path + ".tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+    def read_bytes(self, bucket, key):
+        with open(self.path(bucket, key), 'rb') as f:
+            return f.read()
+
+    def delete(self, bucket, key):
+        path = self.path(bucket, key)
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def get_storage(backend=None):
+    """Build the storage backend selected by STORAGE_BACKEND"""
+    backend = (backend or config.STORAGE_BACKEND).lower()
+    if backend == 's3':
+        return S3Storage()
+    if backend == 'local':
+        return LocalStorage(config.LOCAL_STORAGE_ROOT)
+    raise ValueError("Unknown storage backend: " + backend)
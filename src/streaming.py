@@ -0,0 +1,189 @@
+# Micro-batch Streaming -- watch a landing prefix and push new files through all layers
+
+import os
+import sys
+import time
+import logging
+from datetime import datetime, timezone
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import config
+from Bronze import BronzeLayer
+from Silver import SilverLayer
+from Gold import GoldLayer
+from storage import get_storage
+from service import publish_database
+from sql.transformations import STREAM_PROCESSED_FILES_TABLE, STREAM_BATCH_METRICS_TABLE
+
+logger = logging.getLogger(__name__)
+
+
+class MicroBatchStream:
+    """Groups new landing files into micro-batches and runs each batch through
+    Bronze, Silver and Gold.
+
+    Each batch appends its Bronze and Silver rows as new snapshots, replaces the Gold
+    snapshots and then records the batch's row fingerprints. A snapshot already
+    committed by a batch that then fails is not undone, so the retried batch can be
+    appended to Bronze or Silver twice. Rows are deduplicated against the stored
+    fingerprint index, and Silver starts from the stored snapshot, so Gold covers
+    every run and not only this stream.
+
+    A batch is cut when the pending files reach max_batch_bytes, or when the oldest
+    pending file has waited max_wait_seconds, which bounds end-to-end latency to
+    roughly max_wait_seconds plus one batch's processing time. Processed files are
+    recorded in the same DuckDB database as the data, which is why the stream needs
+    a persistent DUCKDB_DATABASE to resume where it stopped.
+    """
+
+    def __init__(self, storage=None, bucket=None, prefix=None, database=None, save_to_S3=True):
+        self.storage = storage or get_storage()
+        self.bucket = bucket or config.SOURCE_BUCKET
+        self.prefix = prefix if prefix is not None else config.LANDING_PREFIX
+        self.save_to_S3 = save_to_S3
+        self.max_batch_bytes = config.STREAM_MAX_BATCH_BYTES
+        self.max_wait_seconds = config.STREAM_MAX_WAIT_SECONDS
+        self.poll_interval = config.STREAM_POLL_INTERVAL_SECONDS
+        self.latency_target = config.STREAM_LATENCY_TARGET_SECONDS
+
+        self.bronze = BronzeLayer(self.storage, database)
+        self.conn = self.bronze.init_connection()
+        self.silver = SilverLayer(self.conn, self.storage)
+        self.gold = GoldLayer(self.conn, self.storage)
+        if self.save_to_S3:
+            # Full runs may have appended to Silver since this database last streamed
+            self.silver.load_snapshot()
+
+        self.conn.execute(STREAM_PROCESSED_FILES_TABLE)
+        self.conn.execute(STREAM_BATCH_METRICS_TABLE)
+        self.processed = dict(self.conn.execute("SELECT file_key, etag FROM stream_processed_files").fetchall())
+        last_batch = self.conn.execute("SELECT MAX(batch_id) FROM stream_batch_metrics").fetchone()[0]
+        self.batch_id = last_batch or 0
+        self.pending = []
+        self.metrics = []
+
+    def poll(self):
+        pending_keys = set(entry['key'] for entry, _ in self.pending)
+        discovered_at = time.time()
+        new_files = 0
+        listing = self.bronze.metadata.list_prefixes(self.bucket, [self.prefix], refresh=True)[self.prefix]
+        for entry in listing:
+            if not entry['key'].lower().endswith('.csv') or entry['key'] in pending_keys:
+                continue
+            # A re-sent file under the same key shows up as a new ETag
+            if self.processed.get(entry['key']) == entry['etag']:
+                continue
+            self.pending.append((entry, discovered_at))
+            new_files += 1
+        if new_files:
+            logger.info("Discovered {} new landing files, {} pending.".format(str(new_files), str(len(self.pending))))
+        return new_files
+
+    def next_batch(self, flush=False):
+        if not self.pending:
+            return []
+        pending_bytes = sum(entry['size'] for entry, _ in self.pending)
+        oldest_wait = time.time() - self.pending[0][1]
+        if not flush and pending_bytes < self.max_batch_bytes and oldest_wait < self.max_wait_seconds:
+            return []
+
+        batch = []
+        batch_bytes = 0
+        while self.pending:
+            entry, discovered_at = self.pending[0]
+            if batch and batch_bytes + entry['size'] > self.max_batch_bytes:
+                break
+            batch.append(self.pending.pop(0))
+            batch_bytes += entry['size']
+        return batch
+
+    def lag_seconds(self):
+        if not self.pending:
+            return 0.0
+        return time.time() - self.pending[0][1]
+
+    def process_batch(self, batch):
+        self.batch_id += 1
+        started = time.time()
+        entries = [entry for entry, _ in batch]
+        uris = [self.storage.uri(self.bucket, entry['key']) for entry in entries]
+        logger.info("Micro-batch {}: {} files, {} bytes".format(
+            str(self.batch_id), str(len(entries)), str(sum(entry['size'] for entry in entries))))
+
+        self.conn.execute("BEGIN TRANSACTION")
+        try:
+            bronze_rows = self.bronze.ingest_batch(uris)
+            silver_rows = self.silver.process_batch(uris)
+            self.gold.refresh_aggregations()
+            self.conn.executemany(
+                "INSERT INTO stream_processed_files VALUES (?, ?, ?, ?, CURRENT_TIMESTAMP)",
+                [[entry['key'], entry['etag'], entry['size'], self.batch_id] for entry in entries]
+            )
+            if self.save_to_S3:
+                # Exported before COMMIT, so a failed export rolls the batch back and it is retried.
+                # CURRENT_TIMESTAMP is fixed per transaction and selects only this batch's rows.
+                self.bronze.save_to_S3(mode='append', where="ingestion_timestamp = CURRENT_TIMESTAMP")
+                self.silver.save_to_S3(mode='append', where="ingestion_timestamp = CURRENT_TIMESTAMP")
+                self.gold.save_to_S3()
+                self.bronze.commit_fingerprints(where="ingestion_timestamp = CURRENT_TIMESTAMP")
+            self.conn.execute("COMMIT")
+        except Exception:
+            self.conn.execute("ROLLBACK")
+            self.batch_id -= 1
+            # Put the files back so the next poll retries them
+            self.pending = batch + self.pending
+            raise
+
+        for entry in entries:
+            self.processed[entry['key']] = entry['etag']
+        if config.SERVICE_DATABASE:
+            publish_database(self.conn, ['silver_heart_disease'] + self.gold.gold_tables)
+
+        completed = time.time()
+        arrivals = [entry['last_modified'].timestamp() if entry.get('last_modified') else discovered_at
+                    for entry, discovered_at in batch]
+        metrics = {
+            'batch_id': self.batch_id,
+            'file_count': len(entries),
+            'batch_bytes': sum(entry['size'] for entry in entries),
+            'bronze_rows': bronze_rows,
+            'silver_rows': silver_rows,
+            'processing_seconds': completed - started,
+            'end_to_end_latency_seconds': completed - min(arrivals),
+            'pending_files': len(self.pending),
+            'lag_seconds': self.lag_seconds(),
+            'completed_at': datetime.now(timezone.utc).replace(tzinfo=None)
+        }
+        self.conn.execute(
+            "INSERT INTO stream_batch_metrics VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", list(metrics.values()))
+        self.metrics.append(metrics)
+
+        logger.info("Micro-batch {} done: processing {:.2f}s, end-to-end latency {:.2f}s, {} files pending, lag {:.2f}s".format(
+            str(self.batch_id), metrics['processing_seconds'], metrics['end_to_end_latency_seconds'],
+            str(metrics['pending_files']), metrics['lag_seconds']), extra={'batch_metrics': metrics})
+        if metrics['end_to_end_latency_seconds'] > self.latency_target:
+            logger.warning("Micro-batch {} exceeded the {:.0f}s latency target.".format(
+                str(self.batch_id), self.latency_target))
+        return metrics
+
+    def run(self, max_batches=None):
+        logger.info("Streaming from {} every {:.0f}s (batch <= {} bytes or {:.0f}s wait, latency target {:.0f}s)".format(
+            self.storage.uri(self.bucket, self.prefix), self.poll_interval, str(self.max_batch_bytes),
+            self.max_wait_seconds, self.latency_target))
+        processed_batches = 0
+        try:
+            while max_batches is None or processed_batches < max_batches:
+                self.poll()
+                batch = self.next_batch()
+                while batch:
+                    self.process_batch(batch)
+                    processed_batches += 1
+                    if max_batches is not None and processed_batches >= max_batches:
+                        return self.metrics
+                    batch = self.next_batch()
+                time.sleep(self.poll_interval)
+        except KeyboardInterrupt:
+            logger.info("Streaming stopped. Processed {} micro-batches.".format(str(processed_batches)))
+        return self.metrics
+
+    def close(self):
+        self.bronze.close()
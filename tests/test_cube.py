@@ -0,0 +1,43 @@
+# OLAP Cube -- cube and Silver routes return the same answer
+
+import os
+import sys
+import duckdb
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src'))
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from Cube import CubeQuery
+from sql.transformations import GOLD_CUBE
+
+SILVER = """
+CREATE TABLE silver_heart_disease AS
+SELECT CAST(i AS INTEGER) AS patient_id,
+       CASE WHEN i % 2 = 0 THEN 'Male' ELSE 'Female' END AS sex,
+       CASE WHEN i % 3 = 0 THEN '< 40' ELSE '40-49' END AS age_group,
+       'cleveland' AS dataset,
+       'Asymptomatic' AS chest_pain_type,
+       'Normal' AS thalassemia,
+       CAST(i % 5 AS INTEGER) AS heart_disease_severity,
+       i % 5 > 0 AS has_heart_disease,
+       CAST(30 + i % 40 AS INTEGER) AS age,
+       CAST(110 + i % 50 AS INTEGER) AS resting_blood_pressure,
+       CAST(180 + i % 120 AS INTEGER) AS cholesterol,
+       CAST(100 + i % 90 AS INTEGER) AS max_heart_rate,
+       (i % 40) / 10.0 AS st_depression,
+       i % 7 = 0 AS fasting_blood_sugar_high,
+       i % 4 = 0 AS exercise_induced_angina
+FROM range(1000) t(i)
+"""
+
+
+def test_cube_route_matches_silver_route():
+    conn = duckdb.connect()
+    conn.execute(SILVER)
+    measures = ['patient_count', 'heart_disease_count', 'avg_age']
+    silver = CubeQuery(conn).query(['sex', 'age_group'], measures)
+
+    conn.execute(GOLD_CUBE)
+    cube_query = CubeQuery(conn)
+    cube = cube_query.query(['sex', 'age_group'], measures)
+    assert cube_query.last_route == 'cube'
+    assert list(cube.dtypes) == list(silver.dtypes)
+    assert cube.equals(silver)
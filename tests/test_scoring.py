@@ -0,0 +1,48 @@
+# Risk Scoring Stage -- the Arrow UDF path agrees with the SQL expression
+
+import os
+import sys
+import duckdb
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src'))
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from Scoring import RiskScorer, WeightedRiskModel
+
+RULES = [('age', '>', 55, 2), ('cholesterol', '>=', 240, 1), ('exercise_induced_angina', '=', True, 3)]
+
+# A NULL must satisfy neither `= FALSE` nor `!=`
+NULL_RULES = [('exercise_induced_angina', '=', False, 3), ('age', '!=', 70, 1)]
+
+
+def scores_by_path(conn, rules):
+    scores = []
+    for force_udf in (False, True):
+        expression = RiskScorer(conn, WeightedRiskModel(rules), force_udf=force_udf).expression()
+        scores.append(conn.execute("SELECT list({0} ORDER BY patient_id), any_value(typeof({0})) FROM silver_heart_disease".format(
+            expression)).fetchone())
+    return scores
+
+
+def test_udf_scores_match_sql_scores():
+    conn = duckdb.connect()
+    conn.execute("""
+        CREATE TABLE silver_heart_disease AS
+        SELECT CAST(i AS INTEGER) AS patient_id,
+               CASE WHEN i % 7 = 0 THEN NULL ELSE CAST(40 + i % 30 AS INTEGER) END AS age,
+               CAST(180 + i % 100 AS INTEGER) AS cholesterol,
+               CASE WHEN i % 5 = 0 THEN NULL ELSE i % 3 = 0 END AS exercise_induced_angina
+        FROM range(5000) t(i)
+    """)
+    for rules in (RULES, NULL_RULES, [(column, operator, threshold, 0.5) for column, operator, threshold, _ in RULES]):
+        sql_scores, udf_scores = scores_by_path(conn, rules)
+        assert sql_scores == udf_scores
+
+
+def test_null_inputs_match_no_rule():
+    conn = duckdb.connect()
+    conn.execute("""
+        CREATE TABLE silver_heart_disease AS
+        SELECT * FROM (VALUES (1, 70, FALSE), (2, NULL, FALSE), (3, 60, NULL), (4, NULL, NULL))
+            t(patient_id, age, exercise_induced_angina)
+    """)
+    sql_scores, udf_scores = scores_by_path(conn, NULL_RULES)
+    assert sql_scores == udf_scores == ([3, 3, 1, 0], 'INTEGER')
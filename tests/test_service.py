@@ -0,0 +1,34 @@
+# Query Service -- republishing and the read-only pool
+
+import os
+import sys
+import duckdb
+import pytest
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src'))
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from service import publish_database, QueryService
+
+
+def test_republish_is_served_without_restart(tmp_path):
+    path = str(tmp_path / "warehouse.duckdb")
+    conn = duckdb.connect()
+    conn.execute("CREATE TABLE gold_summary AS SELECT 1 AS total")
+    first = publish_database(conn, ['gold_summary'], path)
+    service = QueryService(path, pool_size=2, cache_size=10)
+    assert service.execute("SELECT total FROM gold_summary")['rows'] == [(1,)]
+
+    conn.execute("CREATE OR REPLACE TABLE gold_summary AS SELECT 2 AS total")
+    second = publish_database(conn, ['gold_summary'], path)
+    result = service.execute("SELECT total FROM gold_summary")
+    assert (result['version'], result['rows']) == (second, [(2,)])
+    assert first != second
+
+
+def test_queries_cannot_read_files(tmp_path):
+    path = str(tmp_path / "warehouse.duckdb")
+    conn = duckdb.connect()
+    conn.execute("CREATE TABLE gold_summary AS SELECT 1 AS total")
+    publish_database(conn, ['gold_summary'], path)
+    service = QueryService(path, pool_size=1, cache_size=10)
+    with pytest.raises(duckdb.Error):
+        service.execute("SELECT * FROM read_csv('/etc/passwd')")
@@ -0,0 +1,53 @@
+# Snapshot Tables -- commit and attach round trip on the local storage backend
+
+import os
+import sys
+import duckdb
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src'))
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from storage import LocalStorage
+from snapshot import SnapshotTable
+
+SOURCE = """
+SELECT CAST(i AS INTEGER) AS patient_id, DATE '2024-01-01' + CAST(i AS INTEGER) AS visit_date,
+       CASE WHEN i % 4 = 0 THEN NULL ELSE 'p' || i END AS note
+FROM range({}, {}) t(i)
+"""
+
+
+def make_table(tmp_path):
+    storage = LocalStorage(str(tmp_path / "storage"))
+    return SnapshotTable("patients", "bronze/", storage, "warehouse")
+
+
+def test_commit_then_attach_round_trip(tmp_path):
+    conn = duckdb.connect()
+    table = make_table(tmp_path)
+    staging_dir = str(tmp_path / "staging" / "not_created_yet")
+
+    manifest = table.commit(conn, SOURCE.format(0, 100), staging_dir=staging_dir)
+    assert manifest['row_count'] == 100
+    assert table.pointer()['snapshot_id'] == manifest['snapshot_id']
+
+    stats = manifest['files'][0]['column_stats']
+    assert (stats['patient_id']['min'], stats['patient_id']['max']) == (0, 99)
+    assert (stats['visit_date']['min'], stats['visit_date']['max']) == ('2024-01-01', '2024-04-09')
+    assert stats['note']['null_count'] == 25
+
+    table.attach(conn, "patients_view")
+    assert conn.execute("SELECT COUNT(*), SUM(patient_id) FROM patients_view").fetchone() == (100, 4950)
+
+
+def test_append_keeps_parent_files_and_prunes_on_stats(tmp_path):
+    conn = duckdb.connect()
+    table = make_table(tmp_path)
+    first = table.commit(conn, SOURCE.format(0, 100), staging_dir=str(tmp_path / "staging"))
+    second = table.commit(conn, SOURCE.format(100, 150), mode='append', staging_dir=str(tmp_path / "staging"))
+
+    assert second['parent_snapshot_id'] == first['snapshot_id']
+    assert second['row_count'] == 150
+    assert len(table.files()) == 2
+    assert len(table.files(filters={'patient_id': ('>=', 120)})) == 1
+
+    table.attach(conn, "patients_view", snapshot_id=first['snapshot_id'])
+    assert conn.execute("SELECT COUNT(*) FROM patients_view").fetchone()[0] == 100